@@ -1,5 +1,28 @@
 #include <Arduino.h>
 
+// Set PIXEL_COUNT to the length of an addressable (WS2812) strip on data_pin
+// to receive multi-pixel frames; with 1 the sketch drives an analog RGB strip.
+#define PIXEL_COUNT 1
+
+#if PIXEL_COUNT > 1
+#include <FastLED.h>
+
+const int data_pin = 6;
+const byte frame_sync = 0xA5;
+// Packet types, see encoding.py.
+const byte frame_raw = 0x01;
+const byte frame_delta = 0x02;
+const byte frame_rle = 0x03;
+// One reply per packet: ack once the strip shows it, nak when it was
+// rejected. The host sends nothing else until the reply arrives.
+const byte frame_ack = 0x06;
+const byte frame_nak = 0x15;
+// Longest pause inside a packet before it is given up.
+const unsigned long byte_timeout = 50;
+
+CRGB leds[PIXEL_COUNT];
+#endif
+
 const int red_pin = 11;
 const int green_pin = 10;
 const int blue_pin = 9;
@@ -11,21 +34,138 @@ void SetColorLED(int r, int g, int b)
   analogWrite(blue_pin, b);
 }
 
+#if PIXEL_COUNT > 1
+// Fletcher-16 of the packet so far, see encoding.py.
+byte sum1, sum2;
+bool failed;
+
+void Checksum(const byte* data, int length)
+{
+  for(int i = 0; i < length; i++) {
+    sum1 = (sum1 + data[i]) % 255;
+    sum2 = (sum2 + sum1) % 255;
+  }
+}
+
+void ReadInto(void* data, int length)
+{
+  if(failed) {
+    return;
+  }
+  if(Serial.readBytes((char*)data, length) != (size_t)length) {
+    failed = true;
+    return;
+  }
+  Checksum((const byte*)data, length);
+}
+
+byte ReadByte()
+{
+  byte value = 0;
+  ReadInto(&value, 1);
+  return value;
+}
+
+unsigned int ReadWord()
+{
+  unsigned int high = ReadByte();
+  return (high << 8) | ReadByte();
+}
+
+void Reject()
+{
+  // The rest of the packet is dropped before replying, so none of it is
+  // taken for the start of the next one.
+  unsigned long last = millis();
+  while(millis() - last < 5) {
+    if(Serial.available() > 0) {
+      Serial.read();
+      last = millis();
+    }
+  }
+  Serial.write(frame_nak);
+}
+
+void ReadFrame()
+{
+  while(Serial.available() < 1 || Serial.read() != frame_sync) {}
+  sum1 = 0;
+  sum2 = 0;
+  failed = false;
+  byte sync = frame_sync;
+  Checksum(&sync, 1);
+  byte type = ReadByte();
+  unsigned int count = ReadWord();
+  bool valid = !failed;
+  if(type == frame_raw) {
+    valid = valid && count == PIXEL_COUNT;
+    if(valid) {
+      ReadInto(leds, PIXEL_COUNT * 3);
+    }
+  } else if(type == frame_delta) {
+    // Spans of changed pixels, the rest keep their color.
+    for(unsigned int i = 0; i < count && valid && !failed; i++) {
+      unsigned int start = ReadWord();
+      unsigned int length = ReadWord();
+      valid = (unsigned long)start + length <= PIXEL_COUNT;
+      if(valid) {
+        ReadInto(leds + start, length * 3);
+      }
+    }
+  } else if(type == frame_rle) {
+    // The runs must cover the strip exactly.
+    unsigned int pixel = 0;
+    for(unsigned int i = 0; i < count && valid && !failed; i++) {
+      byte run[4];
+      ReadInto(run, 4);
+      valid = pixel + run[0] <= PIXEL_COUNT;
+      if(valid) {
+        fill_solid(leds + pixel, run[0], CRGB(run[1], run[2], run[3]));
+        pixel += run[0];
+      }
+    }
+    valid = valid && pixel == PIXEL_COUNT;
+  } else {
+    valid = false;
+  }
+  unsigned int expected = ((unsigned int)sum2 << 8) | sum1;
+  if(!valid || failed || ReadWord() != expected || failed) {
+    // Pixels already written stay hidden; the host answers a nak with a
+    // keyframe that replaces them.
+    Reject();
+    return;
+  }
+  FastLED.show();
+  Serial.write(frame_ack);
+}
+#endif
+
 void setup() {
   Serial.begin(115200);
+#if PIXEL_COUNT > 1
+  Serial.setTimeout(byte_timeout);
+#else
   Serial.setTimeout(5000);
+#endif
   pinMode(red_pin, OUTPUT);
   pinMode(green_pin, OUTPUT);
   pinMode(blue_pin, OUTPUT);
+#if PIXEL_COUNT > 1
+  FastLED.addLeds<WS2812B, data_pin, GRB>(leds, PIXEL_COUNT);
+#endif
 }
 
 void loop() {
+#if PIXEL_COUNT > 1
+  ReadFrame();
+#else
   String r, g, b;
-  
+
     while(Serial.available()<3) {}
       r = Serial.read();
       g = Serial.read();
       b = Serial.read();
 
     SetColorLED(r.toInt(),g.toInt(),b.toInt());
+#endif
 }
@@ -1,34 +1,247 @@
 import struct
+import threading
 import time
 import serial
 import logging
+import metrics
+from encoding import FRAME_ACK, FRAME_NAK, FrameEncoder
 
 
 class ArduinoSerial(serial.Serial):
     logger = logging.getLogger(__name__)
+    bytes_total = metrics.counter(
+        "serial_bytes_total", "Bytes written to the Arduino serial port."
+    )
+    write_seconds = metrics.histogram(
+        "serial_write_seconds", "Time spent writing one frame to the serial port."
+    )
+    reconnects_total = metrics.counter(
+        "serial_reconnects_total", "Times the serial port was reopened after a fault."
+    )
+    outage_seconds_total = metrics.counter(
+        "serial_outage_seconds_total", "Time the serial port was unavailable."
+    )
+    rejected_total = metrics.counter(
+        "serial_rejected_packets_total", "Packets the Arduino rejected."
+    )
+    reply_timeouts_total = metrics.counter(
+        "serial_reply_timeouts_total", "Packets the Arduino never answered."
+    )
+    frames_dropped_total = metrics.counter(
+        "serial_frames_dropped_total",
+        "Frames replaced by a newer one while the Arduino was busy.",
+    )
 
-    def __init__(self, port, baudrate=115200, timeout=0.05, arduino=True):
+    def __init__(
+        self,
+        port,
+        baudrate=115200,
+        timeout=0.05,
+        arduino=True,
+        pixels=1,
+        encoding="auto",
+        max_backoff=10.0,
+        reply_timeout=0.1,
+    ):
         self.with_arduino = arduino
+        self.pixels = pixels
+        self.encoder = FrameEncoder(pixels, encoding)
+        self.max_backoff = max_backoff
+        self._device = port
+        self._connect_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._outage = None
+        # Bumped when start_serial takes over from a pending reconnect, which
+        # then leaves the port alone.
+        self._generation = 0
+        self._resync = False
+        # Multi-pixel packets go out one at a time: while one is unanswered,
+        # the newest frame is held and older held frames are dropped.
+        self.reply_timeout = reply_timeout
+        self._frame_lock = threading.Lock()
+        self._awaiting = None
+        self._held = None
         if self.with_arduino == True:
-            super().__init__(port=port, baudrate=baudrate, timeout=timeout)
-            time.sleep(0.3)
+            # port=None keeps the port closed until start_serial is called.
+            super().__init__(port=None, baudrate=baudrate, timeout=timeout)
+
+    @classmethod
+    def from_config(cls, config: dict, **overrides):
+        kwargs = dict(
+            port=config.get("arduino_port"),
+            arduino=True if config.get("arduino").lower() == "on" else False,
+            pixels=int(config.get("pixel_count", "1")),
+            encoding=config.get("serial_encoding", "auto").lower(),
+        )
+        kwargs.update(overrides)
+        return cls(**kwargs)
 
     def start_serial(self):
-        if self.with_arduino and not self.is_open:
-            ArduinoSerial.logger.info("Serial communication has started.")
-            self.open()
-            time.sleep(0.3)
+        with self._connect_lock:
+            if self.with_arduino and (not self.is_open or self._outage is not None):
+                ArduinoSerial.logger.info("Serial communication has started.")
+                if self._outage is not None:
+                    # Open the port now instead of waiting for the backoff.
+                    self._generation += 1
+                    ArduinoSerial.outage_seconds_total.inc(
+                        time.monotonic() - self._outage
+                    )
+                    self._outage = None
+                self._closing.clear()
+                try:
+                    if self.is_open:
+                        self.close()
+                    self._open()
+                except (serial.SerialException, OSError) as e:
+                    self._lost(e)
 
     def close_serial(self):
         if self.with_arduino:
             ArduinoSerial.logger.info("Serial communication has closed.")
+            # Stops a reconnect in progress.
+            self._closing.set()
             if self.is_open:
                 self.communicate((0, 0, 0))
-                self.close()
+                self.wait_shown()
+            with self._connect_lock:
+                if self.is_open:
+                    self.close()
 
     def communicate(self, rgb: tuple):
-        if self.with_arduino and self.is_open:
+        if self.pixels > 1:
+            self.communicate_frame(bytes(rgb) * self.pixels)
+        elif self.connected():
             r, g, b = rgb
-            self.write(struct.pack(">B", r))
-            self.write(struct.pack(">B", g))
-            self.write(struct.pack(">B", b))
+            self._write(struct.pack(">BBB", r, g, b))
+
+    def communicate_frame(self, frame):
+        # Multi-pixel frames are sent as raw, run-length or delta packets,
+        # whichever is smallest, see encoding.py.
+        if self.connected():
+            with self._frame_lock:
+                if self._awaiting is not None:
+                    # Sent by the reply reader once the strip shows the
+                    # previous packet, so the caller never waits for it.
+                    if self._held is not None:
+                        ArduinoSerial.frames_dropped_total.inc()
+                    self._held = bytes(frame)
+                    return
+                self._held = None
+                self._send(frame)
+
+    def wait_shown(self, timeout=1.0):
+        # Waits until the last frame has been answered.
+        deadline = time.monotonic() + timeout
+        while self.connected() and time.monotonic() < deadline:
+            if self._awaiting is None and self._held is None:
+                return True
+            time.sleep(0.001)
+        return False
+
+    def connected(self):
+        return self.with_arduino and self._outage is None and self.is_open
+
+    def _open(self):
+        self.port = self._device
+        self.open()
+        self._resync = True
+        self._awaiting = None
+        self._held = None
+        time.sleep(0.3)
+        if self.pixels > 1:
+            threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def _send(self, frame):
+        # Called with the frame lock held.
+        if self._resync:
+            # The strip restarted with the port, so begin with a keyframe.
+            self._resync = False
+            self.encoder.reset()
+        packet = self.encoder.encode(frame)
+        if packet:
+            # Ten bits per byte on the wire, then time to show the strip.
+            self._awaiting = (
+                time.monotonic() + len(packet) * 10 / self.baudrate + self.reply_timeout
+            )
+            self._write(packet)
+
+    def _read_replies(self):
+        # Runs while the port is open; ends with a fault or a close.
+        while self.connected():
+            # pyserial raises TypeError when the port closes during a read.
+            try:
+                reply = self.read(1)
+            except (serial.SerialException, OSError, TypeError) as e:
+                if self.connected():
+                    with self._connect_lock:
+                        self._lost(e)
+                return
+            with self._frame_lock:
+                if reply == bytes([FRAME_ACK]):
+                    self._awaiting = None
+                elif reply == bytes([FRAME_NAK]) or (
+                    self._awaiting is not None and time.monotonic() > self._awaiting
+                ):
+                    # The strip may be missing the packet or show part of it,
+                    # so the next one is a keyframe.
+                    if reply == bytes([FRAME_NAK]):
+                        ArduinoSerial.rejected_total.inc()
+                    else:
+                        ArduinoSerial.reply_timeouts_total.inc()
+                    self._awaiting = None
+                    self.encoder.reset()
+                if self._awaiting is None and self._held is not None:
+                    frame, self._held = self._held, None
+                    self._send(frame)
+
+    def _write(self, data: bytes):
+        started = time.perf_counter()
+        try:
+            ArduinoSerial.bytes_total.inc(self.write(data))
+        except (serial.SerialException, OSError) as e:
+            with self._connect_lock:
+                self._lost(e)
+            return
+        ArduinoSerial.write_seconds.observe(time.perf_counter() - started)
+
+    def _lost(self, error):
+        # Called with the connect lock held. Frames are dropped until a
+        # background thread has reopened the port, so the caller never waits
+        # for the device.
+        if self._outage is not None or self._closing.is_set():
+            return
+        ArduinoSerial.logger.warning(
+            f"Serial port {self._device} failed ({error}), reconnecting."
+        )
+        self._outage = time.monotonic()
+        threading.Thread(
+            target=self._reconnect, args=(self._generation,), daemon=True
+        ).start()
+
+    def _reconnect(self, generation):
+        backoff = 0.5
+        while not self._closing.wait(backoff):
+            with self._connect_lock:
+                if generation != self._generation:
+                    return
+                if self._closing.is_set():
+                    break
+                try:
+                    if self.is_open:
+                        self.close()
+                    self._open()
+                except (serial.SerialException, OSError) as e:
+                    ArduinoSerial.logger.debug(f"Serial reconnect failed: {e}")
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                outage = time.monotonic() - self._outage
+                self._outage = None
+            ArduinoSerial.reconnects_total.inc()
+            ArduinoSerial.outage_seconds_total.inc(outage)
+            ArduinoSerial.logger.info(
+                f"Serial port {self._device} reconnected after {outage:.1f}s."
+            )
+            return
+        with self._connect_lock:
+            if generation == self._generation:
+                self._outage = None
@@ -1,12 +1,36 @@
-from pyaudio import PyAudio, paFloat32, paContinue
+from pyaudio import PyAudio, paFloat32, paContinue, paInputOverflow, paInputUnderflow
 import numpy as np
 import scipy, scipy.fftpack
+from filterbank import FilterBank
+from spectral import create_backend
+from hpss import HpssSeparator
+from clock import RealClock
+import metrics
 from math import log2
+import threading
+import time
 import logging
 
 
-class AudioStream(PyAudio):
+class AudioStream:
     logger = logging.getLogger(__name__)
+    _pyaudio = None
+    _pyaudio_lock = threading.Lock()
+    frames_total = metrics.counter(
+        "audio_frames_total", "Audio frames delivered by the input stream."
+    )
+    overflows_total = metrics.counter(
+        "audio_input_overflows_total", "Input overflows reported by PortAudio."
+    )
+    underflows_total = metrics.counter(
+        "audio_input_underflows_total", "Input underflows reported by PortAudio."
+    )
+    silent_frames_total = metrics.counter(
+        "audio_silent_frames_total", "Audio frames skipped by the silence gate."
+    )
+    callback_seconds = metrics.histogram(
+        "audio_callback_seconds", "Time spent in the audio stream callback."
+    )
 
     def __init__(
         self,
@@ -15,92 +39,252 @@ class AudioStream(PyAudio):
         rate,
         device_index,
         format=paFloat32,
+        backend="fft",
+        hop=None,
+        clock=None,
     ):
-        super().__init__()
         self._chunk = chunk
+        self._backend_name = backend
+        self._hop_setting = hop
         self._format = format
         self._channel = channel
         self._rate = rate
         self._device_index = device_index
+        # Spectra are scaled to the configured chunk so energy_range keeps
+        # its meaning when the chunk size is adapted at runtime.
+        self._reference_chunk = chunk
+        self.clock = RealClock() if clock is None else clock
 
+        self.diff_max_energy = -1
+        self.diff_max_freq = -1
+        self.frame_index = 0
+        self.input_overflows = 0
+        self.input_underflows = 0
+        self.callback_time = 0.0
+        self.recorder = None
+        # Held while a block is analysed and recorded, so a step taken under
+        # it reads the features of one frame.
+        self.frame_lock = threading.Lock()
+        self.stream = None
+        self._bands = (3, 80, 1600, "log")
+        self._hpss = None
+        self._silence_power = 0.0
+        self._silence_hold = 1.0
+        self._quiet_frames = 0
+        self.silent = False
+        # Set while there is sound, so an idle consumer can wait for it.
+        self.sound = threading.Event()
+        self.sound.set()
+        self._allocate(chunk)
+
+    def _allocate(self, chunk):
+        self._chunk = chunk
+        # Samples delivered per callback; smaller than the chunk when the
+        # analysis windows overlap. An adapted chunk keeps the configured
+        # overlap, so a larger chunk also lengthens the deadline per hop.
+        hop = self._hop_setting or self._reference_chunk
+        self._hop = max(min(hop * chunk // self._reference_chunk, chunk), 1)
+        self._energy_scale = (self._reference_chunk / chunk) ** 2
         self.data = np.zeros(self._chunk // 2 + 1)
+        # Two spectrum buffers are alternated so the previous spectrum stays
+        # valid while the backend writes the next one.
+        self._spectra = np.zeros((2, self._chunk // 2 + 1))
         self.energy_spectrum = np.zeros(self._chunk // 2 + 1)
         self.previous_energy_spectrum = np.zeros(self._chunk // 2 + 1)
         self.diff_energy_spectrum = np.zeros(self._chunk // 2 + 1)
         self.freqs = np.abs(scipy.fftpack.fftfreq(self._chunk, d=1 / self._rate))[
             : self._chunk // 2 + 1
         ]
-        self.diff_max_energy = -1
-        self.diff_max_freq = -1
         self.lower_freq_index = 0
         self.upper_freq_index = self.freqs[-1]
+        self.set_bands(*self._bands)
 
-        self.stream = self.open(
-            format=self._format,
-            channels=self._channel,
-            rate=self._rate,
-            input=True,
-            frames_per_buffer=self._chunk,
-            input_device_index=self._device_index,
-            stream_callback=self._procces_stream,
+    def set_bands(self, count, fmin, fmax, scale="log"):
+        self._bands = (count, fmin, fmax, scale)
+        self.filterbank = FilterBank(self.freqs, count, fmin, fmax, scale)
+        self.band_energy = np.zeros(count)
+        self.band_diff = np.zeros(count)
+        self.harmonic_spectrum = np.zeros(len(self.freqs))
+        self.percussive_spectrum = np.zeros(len(self.freqs))
+        self.band_harmonic = np.zeros(count)
+        self.band_percussive = np.zeros(count)
+        self.separator = (
+            HpssSeparator(
+                len(self.freqs),
+                self.filterbank.starts[0],
+                self.filterbank.stops[-1],
+                *self._hpss,
+            )
+            if self._hpss is not None
+            else None
         )
-        self.stream.stop_stream()
+        self.backend = create_backend(
+            self._backend_name,
+            self._chunk,
+            self._hop,
+            self.filterbank.starts[0],
+            self.filterbank.stops[-1],
+        )
+
+    def set_hpss(self, frames=None, width=17):
+        # Harmonic/percussive separation over `frames` spectra and `width`
+        # bins; None disables it.
+        self._hpss = None if frames is None else (frames, width)
+        self.set_bands(*self._bands)
+
+    def set_silence_gate(self, threshold_db=None, hold=1.0):
+        # Blocks quieter than threshold_db (RMS, dBFS) for longer than hold
+        # seconds skip the spectral analysis; None disables the gate.
+        self._silence_power = 0.0 if threshold_db is None else 10 ** (threshold_db / 10)
+        self._silence_hold = hold
+        self._quiet_frames = 0
+        if self.silent:
+            self._wake()
+
+    def set_chunk(self, chunk):
+        if chunk == self._chunk:
+            return
+        active = self.stream is not None and self.stream.is_active()
+        self.close_stream()
+        self._allocate(chunk)
+        if active:
+            self.start_stream()
+
+    @classmethod
+    def get_pyaudio(cls):
+        with cls._pyaudio_lock:
+            if cls._pyaudio is None:
+                cls._pyaudio = PyAudio()
+            return cls._pyaudio
+
+    @classmethod
+    def terminate(cls):
+        with cls._pyaudio_lock:
+            if cls._pyaudio is not None:
+                cls._pyaudio.terminate()
+                cls._pyaudio = None
+
+    def open_stream(self):
+        if self.stream is None:
+            self.stream = AudioStream.get_pyaudio().open(
+                format=self._format,
+                channels=self._channel,
+                rate=self._rate,
+                input=True,
+                frames_per_buffer=self._hop,
+                input_device_index=self._device_index,
+                stream_callback=self._procces_stream,
+                start=False,
+            )
+            AudioStream.logger.info("Audio stream has been initialized.")
 
     def start_stream(self):
+        self.open_stream()
         if self.stream.is_stopped():
             AudioStream.logger.info("Audio stream has opened. * Started recording.")
             self.stream.start_stream()
 
+    def input_latency(self):
+        return self.stream.get_input_latency() if self.stream is not None else 0.0
+
+    def record_layout(self):
+        # Samples recorded per frame, and what replay needs to know to
+        # analyse them.
+        return self._hop * self._channel, {}
+
     def _procces_stream(self, in_data, frame_count, time_info, status_flag):
-        self.data = np.frombuffer(in_data, dtype=np.float32)
-        win = np.hanning(self._chunk)
-        data_windowed = self.data * win
-        fft = scipy.fft.fft(data_windowed, n=self._chunk)
-        fft = np.abs(fft[: self._chunk // 2 + 1])
-        self.energy_spectrum = fft**2
+        started = time.perf_counter()
+        if status_flag & paInputOverflow:
+            self.input_overflows += 1
+            AudioStream.overflows_total.inc()
+            AudioStream.logger.debug("Audio input overflow.")
+        if status_flag & paInputUnderflow:
+            self.input_underflows += 1
+            AudioStream.underflows_total.inc()
+            AudioStream.logger.debug("Audio input underflow.")
+        with self.frame_lock:
+            self.process(np.frombuffer(in_data, dtype=np.float32))
+            if self.recorder is not None:
+                self.recorder.add_frame(self.frame_index, self.data, self.clock.time())
+        self.callback_time = time.perf_counter() - started
+        AudioStream.frames_total.inc()
+        AudioStream.callback_seconds.observe(self.callback_time)
+
+        return (in_data, paContinue)
+
+    def process(self, data):
+        self.data = data
+        self.frame_index += 1
+        if self._silence_power and self._gate(data):
+            self.backend.skip(data)
+            AudioStream.silent_frames_total.inc()
+            return
+        energy_spectrum = self._spectra[self.frame_index % 2]
+        self.backend.spectrum(data, energy_spectrum)
+        if self._energy_scale != 1:
+            energy_spectrum *= self._energy_scale
+        self.energy_spectrum = energy_spectrum
         self.diff_energy_spectrum = np.maximum(
             self.energy_spectrum - self.previous_energy_spectrum, 0
         )
         self.previous_energy_spectrum = self.energy_spectrum
+        self.band_energy, self.band_diff = self.filterbank.apply(
+            self.energy_spectrum, self.diff_energy_spectrum
+        )
+        if self.separator is not None:
+            harmonic, percussive = self.separator.separate(self.energy_spectrum)
+            self.harmonic_spectrum, self.percussive_spectrum = harmonic, percussive
+            self.band_harmonic, self.band_percussive = self.filterbank.apply(
+                harmonic, percussive
+            )
 
-        return (in_data, paContinue)
+    def _gate(self, data):
+        if np.dot(data, data) >= self._silence_power * len(data):
+            self._quiet_frames = 0
+            if self.silent:
+                self._wake()
+            return False
+        self._quiet_frames += 1
+        if (
+            not self.silent
+            and self._quiet_frames * self._hop >= self._silence_hold * self._rate
+        ):
+            AudioStream.logger.info("Input is silent, spectral analysis paused.")
+            self.silent = True
+            self.sound.clear()
+            self.energy_spectrum = np.zeros(self._chunk // 2 + 1)
+            self.previous_energy_spectrum = self.energy_spectrum
+            self.diff_energy_spectrum = np.zeros(self._chunk // 2 + 1)
+            self.band_energy = np.zeros(self.filterbank.count)
+            self.band_diff = np.zeros(self.filterbank.count)
+            self.harmonic_spectrum = self.percussive_spectrum = self.energy_spectrum
+            self.band_harmonic = self.band_percussive = self.band_diff
+        return self.silent
 
-    def get_max_diff_freq_energy(self, freq_bounds: list):
-        res = []
-        for frange in freq_bounds:
-            lower_bound, upper_bound = frange
-            inrange_freqs = self.freqs[
-                (self.freqs > lower_bound) & (self.freqs < upper_bound)
-            ]
-            lower_freq_index = np.where(self.freqs == np.min(inrange_freqs))[0][0]
-            upper_freq_index = np.where(self.freqs == np.max(inrange_freqs))[0][0]
-            diff_energy_argmax = (
-                np.argmax(
-                    self.diff_energy_spectrum[lower_freq_index : upper_freq_index + 1]
-                )
-                + lower_freq_index
-            )
-            diff_max_frequency = self.freqs[diff_energy_argmax]
-            diff_max_energy = self.diff_energy_spectrum[diff_energy_argmax]
-            res.append((diff_max_frequency, diff_max_energy))
-        return res
+    def _wake(self):
+        AudioStream.logger.info("Input is back, spectral analysis resumed.")
+        self.silent = False
+        self.sound.set()
 
     def stop_stream(self):
-        if self.stream.is_active():
+        if self.stream is not None and self.stream.is_active():
             self.stream.stop_stream()
             AudioStream.logger.info("Audio stream has stopped. * Stopped recording.")
 
     def close_stream(self):
-        self.stream.stop_stream()
-        self.stream.close()
-        AudioStream.logger.info("Audio stream has closed. * Stopped recording.")
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+            AudioStream.logger.info("Audio stream has closed. * Stopped recording.")
 
     def enum_devices(self):
-        for i in range(self.get_device_count()):
+        pyaudio = AudioStream.get_pyaudio()
+        for i in range(pyaudio.get_device_count()):
             print(
                 i,
-                self.get_device_info_by_index(i)["name"],
-                self.get_device_info_by_index(i)["maxInputChannels"],
+                pyaudio.get_device_info_by_index(i)["name"],
+                pyaudio.get_device_info_by_index(i)["maxInputChannels"],
             )
 
     @staticmethod
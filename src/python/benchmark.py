@@ -0,0 +1,242 @@
+import argparse
+import os
+import select
+import threading
+import time
+
+import numpy as np
+
+from effects import EFFECTS, create_effect
+from encoding import FRAME_ACK, FrameDecoder, FrameEncoder
+from filterbank import FilterBank
+from hpss import HpssSeparator
+from spectral import BACKENDS, create_backend
+
+
+def measure(function, repeat: int):
+    function()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat
+
+
+def benchmark_effects(args):
+    rng = np.random.default_rng(0)
+    band_energy = rng.random(args.bands) * 1000
+    band_diff = rng.random(args.bands) * 100
+    print(f"{'effect':<10}{'pixels':>8}{'us/frame':>12}")
+    for name in EFFECTS:
+        effect = create_effect(name, args.pixels, args.bands)
+        seconds = measure(
+            lambda: effect.render(band_energy, band_diff, (255, 0, 0)), args.repeat
+        )
+        print(f"{name:<10}{args.pixels:>8}{seconds * 1e6:>12.1f}")
+
+
+def benchmark_spectral(args):
+    rng = np.random.default_rng(0)
+    freqs = np.fft.rfftfreq(args.chunk, d=1 / args.rate)
+    print(
+        f"{'bands (Hz)':<14}{'bins':>6}{'hop':>6}{'latency ms':>12}"
+        + "".join(f"{name + ' us/hop':>16}" for name in BACKENDS)
+        + "".join(f"{name + ' cpu %':>12}" for name in BACKENDS)
+    )
+    for upper in args.upper:
+        filterbank = FilterBank(freqs, 1, args.lower, upper, "linear")
+        lower_bin, upper_bin = filterbank.starts[0], filterbank.stops[-1]
+        for hop in args.hops:
+            block = rng.standard_normal(hop)
+            out = np.zeros(len(freqs))
+            seconds = {}
+            for name in BACKENDS:
+                backend = create_backend(name, args.chunk, hop, lower_bin, upper_bin)
+                seconds[name] = measure(
+                    lambda: backend.spectrum(block, out), args.repeat
+                )
+            print(
+                f"{f'{args.lower}-{upper}':<14}{upper_bin - lower_bin:>6}{hop:>6}"
+                f"{hop / args.rate * 1000:>12.1f}"
+                + "".join(f"{seconds[name] * 1e6:>16.1f}" for name in BACKENDS)
+                # Share of one core needed to keep up with the input.
+                + "".join(
+                    f"{seconds[name] * args.rate / hop * 100:>12.2f}"
+                    for name in BACKENDS
+                )
+            )
+
+
+def benchmark_hpss(args):
+    rng = np.random.default_rng(0)
+    freqs = np.fft.rfftfreq(args.chunk, d=1 / args.rate)
+    filterbank = FilterBank(freqs, 1, args.lower, args.upper, "linear")
+    lower_bin, upper_bin = filterbank.starts[0], filterbank.stops[-1]
+    spectra = rng.random((64, len(freqs)))
+    separator = HpssSeparator(len(freqs), lower_bin, upper_bin, args.frames, args.width)
+    ring = np.zeros((args.frames, upper_bin - lower_bin))
+    frames = iter(range(1 << 62))
+
+    def separate():
+        separator.separate(spectra[next(frames) % len(spectra)])
+
+    def time_median():
+        separator.time_median.push(
+            spectra[next(frames) % len(spectra)][lower_bin:upper_bin]
+        )
+
+    def sorted_median():
+        # The time median computed with a full sort of the ring.
+        i = next(frames)
+        ring[i % args.frames] = spectra[i % len(spectra)][lower_bin:upper_bin]
+        np.median(ring, axis=0)
+
+    print(f"{upper_bin - lower_bin} bins, {args.frames} frames, {args.width} bins wide")
+    print(
+        f"{'':<14}{'us/frame':>10}"
+        + "".join(f"{f'cpu % @{hop}':>14}" for hop in args.hops)
+    )
+    for name, function in (
+        ("separation", separate),
+        ("time median", time_median),
+        ("np.median", sorted_median),
+    ):
+        seconds = measure(function, args.repeat)
+        print(
+            f"{name:<14}{seconds * 1e6:>10.1f}"
+            # Share of one core needed to keep up with the input.
+            + "".join(f"{seconds * args.rate / hop * 100:>14.2f}" for hop in args.hops)
+        )
+
+
+def render_show(path, effect: str, pixels: int):
+    # Effect frames for a WAV file or a frame recording, computed the way the
+    # reactive loop computes them.
+    from lightshow import read_audio
+    from recorder import read_recording
+    from reactiveprocessing import ReactiveProcessing, read_config
+
+    if path.lower().endswith(".wav"):
+        rate, samples = read_audio(path)
+    else:
+        header, records = read_recording(path)
+        rate, samples = header["config"]["rate"], records["samples"].ravel()
+    processing = ReactiveProcessing.from_config(
+        read_config(),
+        arduino_on=False,
+        channel=1,
+        rate=rate,
+        device_index=None,
+        effect=effect,
+        pixel_count=pixels,
+    )
+    hop = processing.audio._hop
+    frames = []
+    for i in range(len(samples) // hop):
+        processing.audio.process(samples[i * hop : (i + 1) * hop])
+        color, power = processing.step((i + 1) * hop / rate)
+        processing.output(color)
+        frames.append(processing.frame.copy())
+    return frames, rate / hop
+
+
+def benchmark_serial(args):
+    from arduinoserial import ArduinoSerial
+
+    frames, frame_rate = render_show(args.show, args.effect, args.pixels)
+    print(
+        f"{len(frames)} frames of {args.pixels} pixels at {frame_rate:.1f} fps, "
+        f"{args.baudrate} baud"
+    )
+    print(
+        f"{'encoding':<10}{'bytes/frame':>12}{'max':>8}{'max fps':>10}"
+        f"{'encode us':>11}{'pty fps':>10}{'decoded':>9}"
+    )
+    for mode in ("raw", "auto"):
+        encoder = FrameEncoder(args.pixels, mode)
+        started = time.perf_counter()
+        packets = [encoder.encode(frame) for frame in frames]
+        encode_time = (time.perf_counter() - started) / len(frames)
+        sizes = np.array([len(packet) for packet in packets])
+
+        # A pseudo-terminal stands in for the Arduino: the port writes to the
+        # slave side and a reader decodes what arrives on the master side and
+        # answers every packet. Each frame waits for its answer, so none is
+        # dropped.
+        master, slave = os.openpty()
+        serial = ArduinoSerial(os.ttyname(slave), pixels=args.pixels, encoding=mode)
+        serial.start_serial()
+        decoder = FrameDecoder(args.pixels)
+        decoded = []
+        done = threading.Event()
+
+        def read():
+            while not done.is_set():
+                if select.select([master], [], [], 0.05)[0]:
+                    for reply, strip in decoder.feed(os.read(master, 65536)):
+                        os.write(master, bytes([reply]))
+                        if reply == FRAME_ACK:
+                            decoded.append(strip)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        started = time.perf_counter()
+        for frame in frames:
+            serial.communicate_frame(frame)
+            serial.wait_shown()
+        elapsed = time.perf_counter() - started
+        # Closes while the reader still answers the final blackout.
+        serial.close_serial()
+        done.set()
+        reader.join(timeout=10)
+        os.close(master)
+        os.close(slave)
+
+        sent = [frame for frame, packet in zip(frames, packets) if packet]
+        correct = sum(np.array_equal(a, b) for a, b in zip(decoded, sent))
+        print(
+            f"{mode:<10}{sizes.mean():>12.1f}{sizes.max():>8}"
+            # Ten bits per byte on the wire with start and stop bits.
+            f"{args.baudrate / 10 / max(sizes.mean(), 1):>10.1f}"
+            f"{encode_time * 1e6:>11.1f}{len(frames) / elapsed:>10.0f}"
+            f"{f'{correct}/{len(sent)}':>9}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    effects_parser = commands.add_parser("effects")
+    effects_parser.add_argument("--pixels", type=int, default=1000)
+    effects_parser.add_argument("--bands", type=int, default=6)
+    effects_parser.add_argument("--repeat", type=int, default=2000)
+    effects_parser.set_defaults(run=benchmark_effects)
+    spectral_parser = commands.add_parser("spectral")
+    spectral_parser.add_argument("--chunk", type=int, default=2048)
+    spectral_parser.add_argument("--rate", type=int, default=48000)
+    spectral_parser.add_argument("--lower", type=int, default=80)
+    spectral_parser.add_argument(
+        "--upper", type=int, nargs="+", default=[400, 1600, 8000]
+    )
+    spectral_parser.add_argument(
+        "--hops", type=int, nargs="+", default=[2048, 512, 128, 32]
+    )
+    spectral_parser.add_argument("--repeat", type=int, default=500)
+    spectral_parser.set_defaults(run=benchmark_spectral)
+    hpss_parser = commands.add_parser("hpss")
+    hpss_parser.add_argument("--chunk", type=int, default=2048)
+    hpss_parser.add_argument("--rate", type=int, default=48000)
+    hpss_parser.add_argument("--lower", type=int, default=80)
+    hpss_parser.add_argument("--upper", type=int, default=8000)
+    hpss_parser.add_argument("--frames", type=int, default=17)
+    hpss_parser.add_argument("--width", type=int, default=17)
+    hpss_parser.add_argument("--hops", type=int, nargs="+", default=[2048, 512])
+    hpss_parser.add_argument("--repeat", type=int, default=2000)
+    hpss_parser.set_defaults(run=benchmark_hpss)
+    serial_parser = commands.add_parser("serial")
+    serial_parser.add_argument("show", help="WAV file or frame recording")
+    serial_parser.add_argument("--effect", default="bars", choices=list(EFFECTS))
+    serial_parser.add_argument("--pixels", type=int, default=300)
+    serial_parser.add_argument("--baudrate", type=int, default=115200)
+    serial_parser.set_defaults(run=benchmark_serial)
+    args = parser.parse_args()
+    args.run(args)
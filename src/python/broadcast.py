@@ -0,0 +1,301 @@
+from multiprocessing import shared_memory
+import argparse
+import csv
+import sys
+import threading
+import time
+import logging
+
+import numpy as np
+
+MAX_BANDS = 64
+MAX_BINS = 8192 // 2 + 1
+FEATURE_DTYPE = np.dtype(
+    [
+        ("sequence", "<u8"),
+        ("frame", "<u8"),
+        ("time", "<f8"),
+        ("chunk", "<u4"),
+        ("rate", "<u4"),
+        ("bands", "<u4"),
+        ("dominant_freq", "<f8"),
+        ("power", "<f4"),
+        ("rgb", "u1", (3,)),
+        ("onset", "u1"),
+        ("energy_range", "<f8", (2,)),
+        ("freq_range", "<f8", (2,)),
+        ("band_energy", "<f8", (MAX_BANDS,)),
+        ("band_diff", "<f8", (MAX_BANDS,)),
+        ("energy_spectrum", "<f4", (MAX_BINS,)),
+        ("diff_energy_spectrum", "<f4", (MAX_BINS,)),
+    ]
+)
+
+
+class FeatureServer:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, name: str):
+        self.name = name
+        try:
+            self.memory = shared_memory.SharedMemory(
+                name=name, create=True, size=FEATURE_DTYPE.itemsize
+            )
+        except FileExistsError:
+            # The segment may belong to a live server, so it is never removed
+            # here.
+            raise FileExistsError(
+                f"Analysis features are already served as '{name}'. Stop the "
+                f"other server or choose another broadcast name."
+            ) from None
+        self.record = np.ndarray((), dtype=FEATURE_DTYPE, buffer=self.memory.buf)
+        self.record[()] = np.zeros((), dtype=FEATURE_DTYPE)
+        self._flux_average = 0.0
+        self._clamped = False
+        FeatureServer.logger.info(f"Publishing analysis features as '{name}'.")
+
+    def publish(self, processing, color, power, now):
+        audio = processing.audio
+        bands = min(len(audio.band_energy), MAX_BANDS)
+        if bands < len(audio.band_energy) and not self._clamped:
+            self._clamped = True
+            FeatureServer.logger.warning(
+                f"Only the first {MAX_BANDS} of {len(audio.band_energy)} bands "
+                f"are published."
+            )
+        bins = min(len(audio.energy_spectrum), MAX_BINS)
+        flux = audio.band_diff.sum()
+        onset = flux > 1.5 * self._flux_average
+        self._flux_average = 0.9 * self._flux_average + 0.1 * flux
+
+        record = self.record
+        # Seqlock: an odd sequence tells readers a write is in progress.
+        record["sequence"] += 1
+        record["frame"] = audio.frame_index
+        record["time"] = now
+        record["chunk"] = audio._chunk
+        record["rate"] = audio._rate
+        record["bands"] = bands
+        record["dominant_freq"] = processing.dominant_freq
+        record["power"] = power
+        record["rgb"] = color.rgb
+        record["onset"] = onset
+        record["energy_range"] = processing.energy_range
+        record["freq_range"] = processing.freq_range
+        record["band_energy"][:bands] = audio.band_energy[:bands]
+        record["band_diff"][:bands] = audio.band_diff[:bands]
+        record["energy_spectrum"][:bins] = audio.energy_spectrum[:bins]
+        record["diff_energy_spectrum"][:bins] = audio.diff_energy_spectrum[:bins]
+        record["sequence"] += 1
+
+    def close(self):
+        del self.record
+        self.memory.close()
+        self.memory.unlink()
+
+
+class FeatureSubscriber:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, name: str, poll_interval: float = 0.002):
+        self.name = name
+        self.poll_interval = poll_interval
+        self.memory = shared_memory.SharedMemory(name=name)
+        if sys.platform != "win32":
+            # Only the server may unlink the segment; stop the resource
+            # tracker from removing it when this client exits.
+            from multiprocessing import resource_tracker
+
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.record = np.ndarray((), dtype=FEATURE_DTYPE, buffer=self.memory.buf)
+        self.sequence = 0
+
+    def read(self):
+        while True:
+            sequence = int(self.record["sequence"])
+            if sequence % 2 or sequence == self.sequence:
+                return None
+            snapshot = self.record.copy()
+            if int(self.record["sequence"]) == sequence:
+                self.sequence = sequence
+                return snapshot
+
+    def wait(self, timeout: float = 1.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            snapshot = self.read()
+            if snapshot is not None:
+                return snapshot
+            time.sleep(self.poll_interval)
+        return None
+
+    def close(self):
+        del self.record
+        self.memory.close()
+
+
+class RemoteAudio:
+    def __init__(self, chunk, rate):
+        self._chunk = chunk
+        self._rate = rate
+        self.frame_index = 0
+        self.update_bins(chunk, rate)
+
+    def update_bins(self, chunk, rate):
+        self._chunk = chunk
+        self._rate = rate
+        self.freqs = np.fft.rfftfreq(chunk, d=1 / rate)
+        self.energy_spectrum = np.zeros(len(self.freqs))
+        self.diff_energy_spectrum = np.zeros(len(self.freqs))
+
+
+class RemoteAnalysis:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, name, chunk, rate, energy_range):
+        self.name = name
+        self.audio = RemoteAudio(chunk, rate)
+        self.energy_range = list(energy_range)
+        self.freq_range = (0, 400)
+        self.subscriber = None
+        self.running = False
+        self.ready = threading.Event()
+
+    def init_devices(self):
+        if self.subscriber is None:
+            self.subscriber = FeatureSubscriber(self.name)
+            RemoteAnalysis.logger.info(
+                f"Subscribed to analysis features '{self.name}'."
+            )
+        self.ready.set()
+
+    def start(self):
+        self.init_devices()
+        self.running = True
+        while self.running:
+            snapshot = self.subscriber.wait(timeout=0.5)
+            if snapshot is None:
+                continue
+            chunk, rate = int(snapshot["chunk"]), int(snapshot["rate"])
+            if (chunk, rate) != (self.audio._chunk, self.audio._rate):
+                self.audio.update_bins(chunk, rate)
+            bins = len(self.audio.freqs)
+            self.audio.energy_spectrum = snapshot["energy_spectrum"][:bins]
+            self.audio.diff_energy_spectrum = snapshot["diff_energy_spectrum"][:bins]
+            self.audio.frame_index = int(snapshot["frame"])
+            self.energy_range = snapshot["energy_range"].tolist()
+            self.freq_range = tuple(snapshot["freq_range"].tolist())
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.running = False
+        if self.subscriber is not None:
+            self.subscriber.close()
+            self.subscriber = None
+
+    def request_profile(self, duration=None):
+        RemoteAnalysis.logger.info("Profiling runs in the analysis server process.")
+
+
+def serve(config: dict, name: str):
+    from metrics import MetricsServer
+    from reactiveprocessing import ReactiveProcessing
+
+    metrics_port = int(config.get("metrics_port", "0"))
+    metrics_server = MetricsServer(metrics_port) if metrics_port else None
+    if metrics_server is not None:
+        metrics_server.start()
+    processing = ReactiveProcessing.from_config(config, broadcast=name)
+    try:
+        processing.start()
+    except KeyboardInterrupt:
+        processing.stop()
+    finally:
+        processing.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+
+
+def run_leds(config: dict, name: str, timeout: float = 1.0):
+    from arduinoserial import ArduinoSerial
+
+    serial = ArduinoSerial.from_config(config)
+    serial.start_serial()
+    subscriber = FeatureSubscriber(name)
+    dark = False
+    try:
+        while True:
+            snapshot = subscriber.wait(timeout)
+            if snapshot is not None:
+                serial.communicate(tuple(snapshot["rgb"].tolist()))
+                dark = False
+            elif not dark:
+                # The server is idle or gone, so do not leave the last color lit.
+                serial.communicate((0, 0, 0))
+                dark = True
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+        serial.close_serial()
+
+
+def run_logger(name: str, path=None):
+    subscriber = FeatureSubscriber(name)
+    f = open(path, "w", newline="") if path else sys.stdout
+    writer = csv.writer(f)
+    writer.writerow(["frame", "time", "dominant_freq", "power", "r", "g", "b", "onset"])
+    try:
+        while True:
+            snapshot = subscriber.wait()
+            if snapshot is not None:
+                writer.writerow(
+                    [
+                        int(snapshot["frame"]),
+                        f"{float(snapshot['time']):.3f}",
+                        f"{float(snapshot['dominant_freq']):.1f}",
+                        f"{float(snapshot['power']):.1f}",
+                        *snapshot["rgb"].tolist(),
+                        int(snapshot["onset"]),
+                    ]
+                )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+        if path:
+            f.close()
+
+
+if __name__ == "__main__":
+    from reactiveprocessing import read_config
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+    )
+    config = read_config()
+    parser = argparse.ArgumentParser(description="Shared analysis features.")
+    parser.add_argument("--name", default=config.get("broadcast") or "rgb-features")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("serve", help="run the analysis and publish its features")
+    leds_parser = commands.add_parser(
+        "leds", help="drive the Arduino from published colors"
+    )
+    leds_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=1.0,
+        help="seconds without features before the LEDs go dark",
+    )
+    logger_parser = commands.add_parser("log", help="write published features as CSV")
+    logger_parser.add_argument("--csv")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(config, args.name)
+    elif args.command == "leds":
+        run_leds(config, args.name, args.timeout)
+    else:
+        run_logger(args.name, args.csv)
@@ -0,0 +1,196 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import json
+import os
+import time
+import logging
+
+import numpy as np
+from scipy.io import wavfile
+
+from audiostream import AudioStream
+from reactiveprocessing import read_config
+
+# Fixed log-spaced bins, so histograms from different tracks and processes
+# can simply be added up.
+ENERGY_BINS = np.geomspace(1e-3, 1e8, 881)
+FREQ_BINS = np.geomspace(20, 24000, 613)
+logger = logging.getLogger(__name__)
+
+
+def read_blocks(path, size: int):
+    # Memory-maps the file and converts one block at a time, so a track is
+    # never held in memory as floats.
+    rate, samples = wavfile.read(path, mmap=True)
+    scale = (
+        float(np.iinfo(samples.dtype).max)
+        if np.issubdtype(samples.dtype, np.integer)
+        else 1.0
+    )
+    blocks = (
+        np.asarray(samples[i : i + size], dtype=np.float32)
+        for i in range(0, len(samples) - size + 1, size)
+    )
+    return rate, (
+        (block.mean(axis=1) if block.ndim > 1 else block) / scale for block in blocks
+    )
+
+
+def percentile(histogram, bins, q):
+    total = histogram.sum()
+    if total == 0:
+        return 0.0
+    index = np.searchsorted(np.cumsum(histogram), q / 100 * total)
+    return float(bins[min(index, len(bins) - 1)])
+
+
+def analyse_track(path, settings: dict):
+    # Runs in a worker process and returns only histograms and counts.
+    started = time.perf_counter()
+    chunk, hop = settings["chunk"], settings["hop"]
+    rate, blocks = read_blocks(path, hop or chunk)
+    audio = AudioStream(
+        chunk=chunk,
+        channel=1,
+        rate=rate,
+        device_index=None,
+        backend=settings["backend"],
+        hop=hop or None,
+    )
+    audio.set_bands(settings["band_count"], *settings["range"], settings["band_scale"])
+    filterbank = audio.filterbank
+    energies = np.zeros(len(ENERGY_BINS) + 1, dtype=np.int64)
+    freqs = np.zeros(len(FREQ_BINS) + 1, dtype=np.int64)
+    bands = np.zeros(filterbank.count, dtype=np.int64)
+    frames = 0
+    for block in blocks:
+        audio.process(block)
+        frames += 1
+        band = np.argmax(audio.band_diff)
+        if audio.band_diff[band] <= 0:
+            continue
+        # The frequency and energy step() would use if this band dominated.
+        freq, energy = filterbank.peak(audio.diff_energy_spectrum, band)
+        bands[band] += 1
+        energies[np.searchsorted(ENERGY_BINS, energy)] += 1
+        freqs[np.searchsorted(FREQ_BINS, freq)] += 1
+    return {
+        "path": path,
+        "seconds": frames * audio._hop / rate,
+        "energies": energies,
+        "freqs": freqs,
+        "bands": bands,
+        "ranges": filterbank.ranges,
+        "elapsed": time.perf_counter() - started,
+    }
+
+
+def summarize(energies, freqs, bands):
+    return {
+        "energy_percentiles": {
+            q: round(percentile(energies, ENERGY_BINS, q), 1) for q in (10, 50, 90, 99)
+        },
+        "freq_percentiles": {
+            q: round(percentile(freqs, FREQ_BINS, q)) for q in (2, 50, 98)
+        },
+        "band_dominance": (bands / max(bands.sum(), 1)).round(3).tolist(),
+    }
+
+
+def suggest_config(config: dict, summary: dict, band_count: int):
+    energy = summary["energy_percentiles"]
+    freq = summary["freq_percentiles"]
+    dominant = sum(share >= 0.05 for share in summary["band_dominance"])
+    suggested = dict(config)
+    # energy_range[1] seeds the adaptive maximum, which tracks the average
+    # peak difference energy.
+    suggested["energy_range"] = str([0, round(energy[50])])
+    suggested["band_range"] = str([freq[2], freq[98]])
+    suggested["band_count"] = str(band_count)
+    suggested["reactive_count"] = str(max(dominant, 2))
+    return suggested
+
+
+def calibrate(paths, config: dict, settings: dict, jobs=None):
+    started = time.perf_counter()
+    energies = np.zeros(len(ENERGY_BINS) + 1, dtype=np.int64)
+    freqs = np.zeros(len(FREQ_BINS) + 1, dtype=np.int64)
+    bands = np.zeros(settings["band_count"], dtype=np.int64)
+    tracks = {}
+    ranges = []
+    seconds = busy = 0.0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(analyse_track, path, settings) for path in paths]
+        # Results are merged as tracks finish, in whatever order that is.
+        for future in as_completed(futures):
+            result = future.result()
+            energies += result["energies"]
+            freqs += result["freqs"]
+            bands += result["bands"]
+            seconds += result["seconds"]
+            busy += result["elapsed"]
+            track = summarize(result["energies"], result["freqs"], result["bands"])
+            tracks[result["path"]] = track
+            logger.info(
+                f"{os.path.basename(result['path'])}: {result['seconds']:.0f}s, "
+                f"energy p50 {track['energy_percentiles'][50]} "
+                f"p90 {track['energy_percentiles'][90]}, dominant band "
+                f"{int(np.argmax(result['bands']))} "
+                f"({max(track['band_dominance']):.0%})."
+            )
+            ranges = result["ranges"]
+    elapsed = time.perf_counter() - started
+    summary = summarize(energies, freqs, bands)
+    logger.info(
+        f"Analysed {len(paths)} tracks ({seconds / 60:.1f} min) in {elapsed:.1f}s, "
+        f"{seconds / elapsed:.0f}x real time on {busy / elapsed:.1f} busy cores."
+    )
+    for (low, high), share in zip(ranges, summary["band_dominance"]):
+        logger.info(f"Band {low:7.0f}-{high:5.0f} Hz dominates {share:.1%} of frames.")
+    return suggest_config(config, summary, settings["band_count"]), summary, tracks
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+    )
+    config = read_config()
+    parser = argparse.ArgumentParser(
+        description="Suggest config.json values from a library of WAV files."
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--output", default="config.suggested.json")
+    parser.add_argument("--report", help="write per-track statistics as JSON")
+    parser.add_argument("--jobs", type=int, help="worker processes (all cores)")
+    parser.add_argument(
+        "--range",
+        type=float,
+        nargs=2,
+        default=[40, 16000],
+        help="frequency range to analyse in Hz",
+    )
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(args.directory)
+        for name in names
+        if name.lower().endswith(".wav")
+    )
+    if not paths:
+        parser.error(f"No WAV files found in {args.directory}.")
+    settings = {
+        "chunk": int(config.get("fft_chunk")),
+        "hop": int(config.get("spectral_hop", "0")),
+        "backend": config.get("spectral_backend", "fft").lower(),
+        "band_count": int(config.get("band_count", "3")),
+        "band_scale": config.get("band_scale", "log"),
+        "range": args.range,
+    }
+    suggested, summary, tracks = calibrate(paths, config, settings, args.jobs)
+    with open(args.output, "w") as f:
+        json.dump(suggested, f, indent=4)
+    logger.info(f"Suggested configuration written to {args.output}.")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"global": summary, "tracks": tracks}, f, indent=4)
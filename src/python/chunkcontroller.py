@@ -0,0 +1,64 @@
+import logging
+
+
+class ChunkController:
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        chunk: int,
+        min_chunk: int = 512,
+        max_chunk: int = 8192,
+        window: float = 2.0,
+        low_headroom: float = 0.3,
+        high_headroom: float = 0.6,
+    ):
+        self.chunk = chunk
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.window = window
+        self.low_headroom = low_headroom
+        self.high_headroom = high_headroom
+        self.adjustments = 0
+        # Smallest chunk that overran; never step back down to it.
+        self._failed_chunk = 0
+        self._reset_window(0)
+
+    def _reset_window(self, overflows):
+        self._elapsed = 0.0
+        self._worst = 0.0
+        self._overflows = overflows
+
+    def observe(self, busy_time: float, deadline: float, overflows: int) -> int:
+        self._elapsed += deadline
+        self._worst = max(self._worst, busy_time / deadline)
+        if self._elapsed < self.window:
+            return self.chunk
+
+        headroom = 1 - self._worst
+        new_overflows = overflows - self._overflows
+        chunk = self.chunk
+        if (new_overflows > 0 or headroom < self.low_headroom) and (
+            chunk < self.max_chunk
+        ):
+            self._failed_chunk = max(self._failed_chunk, chunk)
+            chunk *= 2
+        elif (
+            headroom > self.high_headroom
+            and chunk // 2 >= self.min_chunk
+            and chunk // 2 > self._failed_chunk
+            # Per-frame overhead is mostly fixed, so halving the chunk
+            # roughly doubles the share of the deadline it uses.
+            and 1 - 2 * self._worst > self.low_headroom
+        ):
+            chunk //= 2
+
+        if chunk != self.chunk:
+            self.adjustments += 1
+            ChunkController.logger.info(
+                f"Chunk size {self.chunk} -> {chunk}: headroom {headroom:.0%}, "
+                f"{new_overflows} input overflows in the last {self._elapsed:.1f}s."
+            )
+            self.chunk = chunk
+        self._reset_window(overflows)
+        return self.chunk
@@ -0,0 +1,127 @@
+import heapq
+import itertools
+import threading
+import time
+import logging
+
+
+class ScheduledCall:
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class RealClock:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self._calls = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def time(self):
+        # Monotonic, so wall clock adjustments do not stall or bunch
+        # scheduled calls.
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def wait(self, event: threading.Event, timeout: float):
+        return event.wait(timeout)
+
+    def call_at(self, when: float, callback):
+        # Calls run in order on one worker thread, started on first use.
+        call = ScheduledCall(callback)
+        with self._condition:
+            heapq.heappush(self._calls, (when, next(self._order), call))
+            if self._thread is None:
+                self._closed = False
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return call
+
+    def close(self):
+        # Drops pending calls and ends the worker thread; a later call_at
+        # starts a new one.
+        with self._condition:
+            self._closed = True
+            self._calls.clear()
+            thread, self._thread = self._thread, None
+            self._condition.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (
+                    not self._calls or self._calls[0][0] > time.monotonic()
+                ):
+                    self._condition.wait(
+                        self._calls[0][0] - time.monotonic() if self._calls else None
+                    )
+                if self._closed:
+                    return
+                when, _, call = heapq.heappop(self._calls)
+            if not call.cancelled:
+                try:
+                    call.callback()
+                except Exception:
+                    RealClock.logger.exception("Scheduled call failed.")
+
+
+class VirtualClock:
+    # Time only moves when the owner sleeps, and sleeping returns at once
+    # after running the calls that fell due, so a pipeline driven by this
+    # clock runs as fast as it can compute while seeing the same timestamps
+    # it would see in real time.
+    tolerance = 1e-9
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+        self._calls = []
+        self._order = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.advance(self.now + max(seconds, 0))
+
+    def advance(self, until: float):
+        # Calls scheduled on the same boundary as the wakeup run first, as
+        # they would on a real clock that had overslept by a hair.
+        while self._calls and self._calls[0][0] <= until + self.tolerance:
+            when, _, call = heapq.heappop(self._calls)
+            self.now = max(self.now, when)
+            if not call.cancelled:
+                call.callback()
+        self.now = max(self.now, until)
+
+    def wait(self, event: threading.Event, timeout: float):
+        # Only scheduled calls can set the event, so run them in order until
+        # one does or the timeout is reached.
+        deadline = self.now + timeout
+        while not event.is_set() and self._calls:
+            when = self._calls[0][0]
+            if when > deadline + self.tolerance:
+                break
+            self.advance(when)
+        if not event.is_set():
+            self.now = max(self.now, deadline)
+        return event.is_set()
+
+    def call_at(self, when: float, callback):
+        call = ScheduledCall(callback)
+        heapq.heappush(self._calls, (when, next(self._order), call))
+        return call
+
+    def close(self):
+        self._calls.clear()
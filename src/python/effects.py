@@ -0,0 +1,136 @@
+import numpy as np
+import logging
+
+from rgbcolor import RgbColor
+
+
+def hue_gradient(count: int, hue_min: float = 0, hue_max: float = 280):
+    return np.array(
+        [RgbColor(hsv=(hue, 1, 1)).rgb for hue in np.linspace(hue_min, hue_max, count)],
+        dtype=np.float32,
+    )
+
+
+class Effect:
+    logger = logging.getLogger(__name__)
+    peak_decay = 0.995
+
+    def __init__(self, pixels: int, bands: int, energy_floor: float = 1.0):
+        self.pixels = pixels
+        self.bands = bands
+        self.energy_floor = energy_floor
+        self.frame = np.zeros((pixels, 3), dtype=np.float32)
+        self.output = np.zeros((pixels, 3), dtype=np.uint8)
+        # Position of each pixel along the strip in [0, 1).
+        self._position = np.arange(pixels, dtype=np.float32) / pixels
+        self._lit = np.zeros(pixels, dtype=bool)
+        self._peaks = np.full(bands, energy_floor)
+        self._levels = np.zeros(bands)
+
+    def levels(self, band_energy):
+        # Bands are normalized to their own slowly decaying peak, so quiet
+        # high bands still reach full scale.
+        np.multiply(self._peaks, self.peak_decay, out=self._peaks)
+        np.maximum(self._peaks, band_energy, out=self._peaks)
+        np.maximum(self._peaks, self.energy_floor, out=self._peaks)
+        np.divide(band_energy, self._peaks, out=self._levels)
+        return self._levels
+
+    def render(self, band_energy, band_diff, rgb):
+        self.draw(band_energy, band_diff, rgb)
+        np.copyto(self.output, self.frame, casting="unsafe")
+        return self.output
+
+    def draw(self, band_energy, band_diff, rgb):
+        raise NotImplementedError
+
+
+class SpectrumBars(Effect):
+    def __init__(self, pixels, bands, **kwargs):
+        super().__init__(pixels, bands, **kwargs)
+        self._segment = np.arange(pixels) * bands // pixels
+        self._segment_position = self._position * bands - self._segment
+        self._colors = hue_gradient(bands)[self._segment]
+        self._pixel_level = np.zeros(pixels)
+
+    def draw(self, band_energy, band_diff, rgb):
+        np.take(self.levels(band_energy), self._segment, out=self._pixel_level)
+        np.less(self._segment_position, self._pixel_level, out=self._lit)
+        np.multiply(self._colors, self._lit[:, None], out=self.frame)
+
+
+class VuMeter(Effect):
+    def __init__(self, pixels, bands, **kwargs):
+        super().__init__(pixels, bands, **kwargs)
+        self._colors = hue_gradient(pixels, 120, 0)
+
+    def draw(self, band_energy, band_diff, rgb):
+        level = self.levels(band_energy).mean()
+        np.less(self._position, level, out=self._lit)
+        np.multiply(self._colors, self._lit[:, None], out=self.frame)
+
+
+class GradientScroll(Effect):
+    speed = 2.0
+
+    def __init__(self, pixels, bands, **kwargs):
+        super().__init__(pixels, bands, **kwargs)
+        self._colors = hue_gradient(pixels, 0, 360)
+        self._index = np.arange(pixels)
+        self._shifted = np.zeros(pixels, dtype=np.intp)
+        self._offset = 0.0
+
+    def draw(self, band_energy, band_diff, rgb):
+        level = self.levels(band_energy).mean()
+        self._offset = (self._offset + self.speed * (0.2 + level)) % self.pixels
+        np.add(self._index, int(self._offset), out=self._shifted)
+        np.remainder(self._shifted, self.pixels, out=self._shifted)
+        np.take(self._colors, self._shifted, axis=0, out=self.frame)
+        self.frame *= 0.2 + 0.8 * level
+
+
+class BeatChase(Effect):
+    speed = 3.0
+    trail_decay = 0.8
+    max_pulses = 16
+
+    def __init__(self, pixels, bands, **kwargs):
+        super().__init__(pixels, bands, **kwargs)
+        self._pulses = np.full(self.max_pulses, np.inf)
+        self._head_positions = np.zeros(self.max_pulses)
+        self._heads = np.zeros(self.max_pulses, dtype=np.intp)
+        # One spare pixel past the strip, where pulses that ran off are drawn.
+        self._canvas = np.zeros((pixels + 1, 3), dtype=np.float32)
+        self.frame = self._canvas[:pixels]
+        self._flux_average = 0.0
+        self._cooldown = 0
+
+    def draw(self, band_energy, band_diff, rgb):
+        flux = band_diff.sum()
+        beat = flux > 1.5 * self._flux_average and self._cooldown == 0
+        self._flux_average = 0.9 * self._flux_average + 0.1 * flux
+        self._cooldown = max(self._cooldown - 1, 0)
+        if beat:
+            # Reuse the slot of the pulse that is furthest along.
+            self._pulses[np.argmax(self._pulses)] = 0
+            self._cooldown = 4
+
+        self.frame *= self.trail_decay
+        self._pulses += self.speed
+        np.minimum(self._pulses, self.pixels, out=self._head_positions)
+        np.copyto(self._heads, self._head_positions, casting="unsafe")
+        self._canvas[self._heads] = rgb
+
+
+EFFECTS = {
+    "bars": SpectrumBars,
+    "vu": VuMeter,
+    "scroll": GradientScroll,
+    "chase": BeatChase,
+}
+
+
+def create_effect(name: str, pixels: int, bands: int, **kwargs):
+    if name not in EFFECTS:
+        raise ValueError(f"Unknown effect: {name}")
+    return EFFECTS[name](pixels, bands, **kwargs)
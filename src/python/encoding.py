@@ -0,0 +1,195 @@
+import struct
+import logging
+
+import numpy as np
+
+# Every multi-pixel packet starts with the sync byte, a type and a 16-bit
+# big-endian count, followed by:
+#   FRAME_RAW    count pixels of RGB
+#   FRAME_DELTA  count spans of start (16 bit), length (16 bit) and RGB pixels
+#   FRAME_RLE    count runs of length (8 bit) and one RGB pixel
+# and a 16-bit Fletcher checksum of everything before it. Delta packets
+# change the pixels the strip already shows; the other two replace the whole
+# strip. The Arduino answers every packet with FRAME_ACK once the strip shows
+# it, or FRAME_NAK when it was rejected, and the host sends one packet at a
+# time.
+FRAME_SYNC = 0xA5
+FRAME_RAW = 0x01
+FRAME_DELTA = 0x02
+FRAME_RLE = 0x03
+FRAME_ACK = 0x06
+FRAME_NAK = 0x15
+HEADER = struct.Struct(">BBH")
+SPAN = struct.Struct(">HH")
+CHECKSUM = struct.Struct(">H")
+
+
+def fletcher16(data):
+    values = np.frombuffer(bytes(data), dtype=np.uint8).astype(np.int64)
+    # The running sum of running sums weights each byte by its distance
+    # from the end.
+    sum1 = int(values.sum()) % 255
+    sum2 = int(values @ np.arange(len(values), 0, -1)) % 255
+    return sum2 << 8 | sum1
+
+
+def encode_raw(frame):
+    return HEADER.pack(FRAME_SYNC, FRAME_RAW, len(frame)) + frame.tobytes()
+
+
+def encode_delta(frame, previous, max_gap: int = 1):
+    changed = np.flatnonzero((frame != previous).any(axis=1))
+    if len(changed) == 0:
+        return HEADER.pack(FRAME_SYNC, FRAME_DELTA, 0)
+    # Unchanged gaps shorter than a span header are cheaper to resend.
+    breaks = np.flatnonzero(np.diff(changed) > max_gap + 1)
+    starts = changed[np.concatenate(([0], breaks + 1))]
+    stops = changed[np.concatenate((breaks, [len(changed) - 1]))] + 1
+    parts = [HEADER.pack(FRAME_SYNC, FRAME_DELTA, len(starts))]
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        parts.append(SPAN.pack(start, stop - start))
+        parts.append(frame[start:stop].tobytes())
+    return b"".join(parts)
+
+
+def encode_rle(frame):
+    boundaries = np.flatnonzero((frame[1:] != frame[:-1]).any(axis=1)) + 1
+    starts = np.concatenate(([0], boundaries))
+    lengths = np.diff(np.concatenate((starts, [len(frame)])))
+    # Runs longer than 255 pixels are split into several runs.
+    pieces = (lengths + 254) // 255
+    run = np.repeat(np.arange(len(starts)), pieces)
+    offset = np.arange(len(run)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    piece_lengths = np.minimum(lengths[run] - offset * 255, 255)
+    body = np.empty((len(run), 4), dtype=np.uint8)
+    body[:, 0] = piece_lengths
+    body[:, 1:] = frame[starts[run]]
+    return HEADER.pack(FRAME_SYNC, FRAME_RLE, len(run)) + body.tobytes()
+
+
+class FrameEncoder:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, pixels: int, mode: str = "auto", keyframe_interval: int = 30):
+        if mode not in ("auto", "raw"):
+            raise ValueError(f"Unknown frame encoding: {mode}")
+        self.pixels = pixels
+        self.mode = mode
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.frames = 0
+        self.bytes = 0
+        self.packets = {FRAME_RAW: 0, FRAME_DELTA: 0, FRAME_RLE: 0}
+
+    def reset(self):
+        # The strip state is unknown, e.g. after reconnecting.
+        self.previous = None
+
+    def encode(self, frame):
+        # Returns the smallest packet for the frame, or b"" when the strip
+        # already shows it.
+        frame = np.frombuffer(bytes(frame), dtype=np.uint8).reshape(-1, 3)
+        if self.mode == "raw":
+            packet = encode_raw(frame)
+        else:
+            keyframe = (
+                self.previous is None or self.frames % self.keyframe_interval == 0
+            )
+            if not keyframe and np.array_equal(frame, self.previous):
+                return b""
+            packet = encode_raw(frame)
+            rle = encode_rle(frame)
+            if len(rle) < len(packet):
+                packet = rle
+            if not keyframe:
+                delta = encode_delta(frame, self.previous)
+                if len(delta) < len(packet):
+                    packet = delta
+        packet += CHECKSUM.pack(fletcher16(packet))
+        self.previous = frame
+        self.frames += 1
+        self.bytes += len(packet)
+        self.packets[packet[1]] += 1
+        return packet
+
+
+class FrameDecoder:
+    # Mirrors ReadFrame in RGBController.ino, for tests and benchmarks.
+    def __init__(self, pixels: int):
+        self.pixels = np.zeros((pixels, 3), dtype=np.uint8)
+        self.buffer = bytearray()
+        self.rejected = 0
+
+    def feed(self, data: bytes):
+        # Yields the reply the Arduino would send and the strip after every
+        # complete packet in data.
+        self.buffer += data
+        while True:
+            size = self._packet_size()
+            if size is None:
+                return
+            packet = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            if self._apply(packet):
+                yield FRAME_ACK, self.pixels.copy()
+            else:
+                self.rejected += 1
+                yield FRAME_NAK, self.pixels.copy()
+
+    def _packet_size(self):
+        start = self.buffer.find(bytes([FRAME_SYNC]))
+        if start < 0:
+            self.buffer.clear()
+            return None
+        del self.buffer[:start]
+        if len(self.buffer) < HEADER.size:
+            return None
+        _, kind, count = HEADER.unpack_from(self.buffer)
+        if kind == FRAME_RAW:
+            size = HEADER.size + count * 3
+        elif kind == FRAME_RLE:
+            size = HEADER.size + count * 4
+        elif kind == FRAME_DELTA:
+            size = HEADER.size
+            for _ in range(count):
+                if len(self.buffer) < size + SPAN.size:
+                    return None
+                _, length = SPAN.unpack_from(self.buffer, size)
+                size += SPAN.size + length * 3
+        else:
+            del self.buffer[:1]
+            return self._packet_size()
+        size += CHECKSUM.size
+        return size if len(self.buffer) >= size else None
+
+    def _apply(self, packet):
+        # Returns False for packets the sketch rejects, which leave the strip
+        # as it was.
+        (checksum,) = CHECKSUM.unpack_from(packet, len(packet) - CHECKSUM.size)
+        if checksum != fletcher16(packet[: -CHECKSUM.size]):
+            return False
+        _, kind, count = HEADER.unpack_from(packet)
+        body = np.frombuffer(packet, dtype=np.uint8, offset=HEADER.size)[
+            : -CHECKSUM.size
+        ]
+        if kind == FRAME_RAW:
+            if count != len(self.pixels):
+                return False
+            self.pixels[:] = body.reshape(-1, 3)
+        elif kind == FRAME_RLE:
+            runs = body.reshape(-1, 4)
+            if runs[:, 0].sum() != len(self.pixels):
+                return False
+            self.pixels[:] = np.repeat(runs[:, 1:], runs[:, 0], axis=0)
+        else:
+            offset = HEADER.size
+            for _ in range(count):
+                start, length = SPAN.unpack_from(packet, offset)
+                offset += SPAN.size
+                if start + length > len(self.pixels):
+                    return False
+                self.pixels[start : start + length] = np.frombuffer(
+                    packet, dtype=np.uint8, count=length * 3, offset=offset
+                ).reshape(-1, 3)
+                offset += length * 3
+        return True
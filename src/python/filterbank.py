@@ -0,0 +1,69 @@
+import numpy as np
+import scipy.sparse
+import logging
+
+
+def hz_to_mel(freq):
+    return 2595 * np.log10(1 + np.asarray(freq) / 700)
+
+
+def mel_to_hz(mel):
+    return 700 * (10 ** (np.asarray(mel) / 2595) - 1)
+
+
+def band_edges(count: int, fmin: float, fmax: float, scale: str = "log"):
+    if scale == "linear":
+        return np.linspace(fmin, fmax, count + 1)
+    if scale == "log":
+        return np.geomspace(fmin, fmax, count + 1)
+    if scale == "mel":
+        return mel_to_hz(np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), count + 1))
+    raise ValueError(f"Unknown band scale: {scale}")
+
+
+class FilterBank:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, freqs, count: int, fmin: float, fmax: float, scale="log"):
+        edges = band_edges(count, fmin, fmax, scale)
+        bounds = np.searchsorted(freqs, edges, side="left")
+        # Narrow low bands can fall between two FFT bins, so every band is
+        # widened to at least one bin and later bands are shifted up.
+        for i in range(1, len(bounds)):
+            bounds[i] = max(bounds[i], bounds[i - 1] + 1)
+        if bounds[-1] > len(freqs):
+            raise ValueError(
+                f"{count} bands do not fit between {fmin} and {fmax} Hz "
+                f"at this FFT resolution."
+            )
+        self.count = count
+        self.starts = bounds[:-1]
+        self.stops = bounds[1:]
+        self.freqs = freqs
+        self.ranges = [
+            (float(freqs[start]), float(freqs[min(stop, len(freqs) - 1)]))
+            for start, stop in zip(self.starts, self.stops)
+        ]
+
+        # Each row averages the bins of one band, so wide high bands do not
+        # dominate narrow low ones just by having more bins.
+        widths = self.stops - self.starts
+        rows = np.repeat(np.arange(count), widths)
+        cols = np.concatenate(
+            [np.arange(start, stop) for start, stop in zip(self.starts, self.stops)]
+        )
+        self.weights = scipy.sparse.csr_matrix(
+            (1 / np.repeat(widths, widths), (rows, cols)), shape=(count, len(freqs))
+        )
+        self._spectra = np.zeros((len(freqs), 2))
+
+    def apply(self, energy_spectrum, diff_energy_spectrum):
+        self._spectra[:, 0] = energy_spectrum
+        self._spectra[:, 1] = diff_energy_spectrum
+        bands = self.weights @ self._spectra
+        return bands[:, 0], bands[:, 1]
+
+    def peak(self, spectrum, band: int):
+        start, stop = self.starts[band], self.stops[band]
+        index = np.argmax(spectrum[start:stop]) + start
+        return self.freqs[index], spectrum[index]
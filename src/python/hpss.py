@@ -0,0 +1,60 @@
+import numpy as np
+import scipy.ndimage
+import logging
+
+
+class RunningMedian:
+    # Median over the last `length` values of each of `width` series, kept
+    # in a ring. A partial sort of the ring costs less in numpy than
+    # maintaining sorted windows with one removal and insertion per update.
+    def __init__(self, width: int, length: int):
+        if length % 2 == 0:
+            raise ValueError("The running median length must be odd.")
+        self.length = length
+        self.ring = np.zeros((width, length))
+        self.position = 0
+        self._window = np.zeros((width, length))
+
+    def push(self, values):
+        self.ring[:, self.position] = values
+        self.position = (self.position + 1) % self.length
+        np.copyto(self._window, self.ring)
+        self._window.partition(self.length // 2, axis=1)
+        return self._window[:, self.length // 2]
+
+
+class HpssSeparator:
+    logger = logging.getLogger(__name__)
+
+    # Median filtering across time keeps sustained (harmonic) partials and
+    # across frequency keeps broadband (percussive) hits; soft masks then
+    # split each frame between the two. Only the bins used by the filterbank
+    # are filtered.
+    def __init__(
+        self, bins: int, lower_bin: int, upper_bin: int, frames=17, width=17, power=2.0
+    ):
+        self.lower_bin = lower_bin
+        self.upper_bin = upper_bin
+        self.width = width | 1
+        self.power = power
+        self.time_median = RunningMedian(upper_bin - lower_bin, frames | 1)
+        self.harmonic = np.zeros(bins)
+        self.percussive = np.zeros(bins)
+        self._frequency_median = np.zeros(upper_bin - lower_bin)
+
+    def separate(self, spectrum):
+        spectrum = spectrum[self.lower_bin : self.upper_bin]
+        harmonic = self.time_median.push(spectrum)
+        percussive = self._frequency_median
+        scipy.ndimage.median_filter(
+            spectrum, size=self.width, output=percussive, mode="nearest"
+        )
+        harmonic = harmonic**self.power
+        mask = harmonic / np.maximum(harmonic + percussive**self.power, 1e-12)
+        self.harmonic[self.lower_bin : self.upper_bin] = spectrum * mask
+        np.subtract(
+            spectrum,
+            self.harmonic[self.lower_bin : self.upper_bin],
+            out=self.percussive[self.lower_bin : self.upper_bin],
+        )
+        return self.harmonic, self.percussive
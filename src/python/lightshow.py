@@ -0,0 +1,117 @@
+import argparse
+import time
+import logging
+
+import numpy as np
+from scipy.io import wavfile
+
+from arduinoserial import ArduinoSerial
+from reactiveprocessing import ReactiveProcessing, read_config
+
+TIMELINE_DTYPE = np.dtype([("time", "<f8"), ("rgb", "u1", (3,))])
+
+
+def read_audio(path):
+    rate, samples = wavfile.read(path)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if np.issubdtype(samples.dtype, np.integer):
+        samples = samples / float(np.iinfo(samples.dtype).max)
+    return rate, samples.astype(np.float32)
+
+
+def render(audio_path, timeline_path, config: dict):
+    rate, samples = read_audio(audio_path)
+    processing = ReactiveProcessing.from_config(
+        config, arduino_on=False, channel=1, rate=rate, device_index=None
+    )
+    chunk = processing.audio._chunk
+    hop = processing.audio._hop
+    frames = len(samples) // hop
+    timeline = np.zeros(frames, dtype=TIMELINE_DTYPE)
+
+    started = time.perf_counter()
+    for i in range(frames):
+        # Stamp each color at the middle of the window it was computed from;
+        # live analysis can only show it after the window has ended.
+        now = max((i + 1) * hop - chunk / 2, 0) / rate
+        processing.audio.process(samples[i * hop : (i + 1) * hop])
+        color, power = processing.step(now)
+        timeline[i]["time"] = now
+        timeline[i]["rgb"] = color.rgb
+    np.save(timeline_path, timeline)
+
+    LightShowPlayer.logger.info(
+        f"Rendered {frames} frames ({frames * hop / rate:.1f}s of audio) "
+        f"to {timeline_path} in {time.perf_counter() - started:.2f}s."
+    )
+    return timeline
+
+
+class LightShowPlayer:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, serial: ArduinoSerial, timeline_path):
+        self.serial = serial
+        timeline = np.load(timeline_path, mmap_mode="r")
+        self.times = timeline["time"].tolist()
+        self.colors = [tuple(rgb) for rgb in timeline["rgb"].tolist()]
+        self.running = False
+        self.late_frames = 0
+
+    def play(self, offset: float = 0.0):
+        LightShowPlayer.logger.info("Light show playback started.")
+        self.running = True
+        self.late_frames = 0
+        self.serial.start_serial()
+        frame_period = self.times[1] - self.times[0] if len(self.times) > 1 else 0
+        # Deadlines are absolute on the monotonic clock, so oversleeping on
+        # one frame shortens the next wait instead of accumulating drift.
+        origin = time.perf_counter() - offset
+        previous = None
+        for timestamp, color in zip(self.times, self.colors):
+            if not self.running:
+                break
+            delay = origin + timestamp - time.perf_counter()
+            if delay < -frame_period:
+                self.late_frames += 1
+                continue
+            if delay > 0:
+                time.sleep(delay)
+            if color != previous:
+                self.serial.communicate(color)
+                previous = color
+        self.running = False
+        self.serial.communicate((0, 0, 0))
+        LightShowPlayer.logger.info(
+            f"Light show playback finished, {self.late_frames} late frames skipped."
+        )
+
+    def stop(self):
+        self.running = False
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+    )
+    parser = argparse.ArgumentParser(description="Pre-rendered light shows.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    render_parser = commands.add_parser("render")
+    render_parser.add_argument("audio")
+    render_parser.add_argument("timeline")
+    play_parser = commands.add_parser("play")
+    play_parser.add_argument("timeline")
+    play_parser.add_argument("--offset", type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = read_config()
+    if args.command == "render":
+        render(args.audio, args.timeline, config)
+    else:
+        serial = ArduinoSerial.from_config(config)
+        player = LightShowPlayer(serial, args.timeline)
+        try:
+            player.play(offset=args.offset)
+        finally:
+            serial.close_serial()
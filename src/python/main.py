@@ -1,5 +1,6 @@
 import sys
 import os
+import argparse
 import traceback
 import json
 import logging
@@ -17,7 +18,10 @@ from matplotlib.animation import FuncAnimation
 from ast import literal_eval
 
 from arduinoserial import ArduinoSerial
-from reactiveprocessing import ReactiveProcessing
+from audiostream import AudioStream
+from reactiveprocessing import ReactiveProcessing, read_config
+from metrics import MetricsServer
+from broadcast import RemoteAnalysis
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -36,24 +40,34 @@ file_handler.setFormatter(formatter)
 logger.addHandler(stdout_handler)
 
 
+class WorkerSignals(QObject):
+    finished = Signal()
+    error = Signal(str)
+
+
 class Worker(QRunnable):
     def __init__(self, fn, *args, **kwargs):
         super(Worker, self).__init__()
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        self.signals = WorkerSignals()
 
     @Slot()
     def run(self):
         try:
             result = self.fn(*self.args, **self.kwargs)
-        except:
+        except Exception as e:
             traceback.print_exc()
+            self.signals.error.emit(str(e))
+        else:
+            self.signals.finished.emit()
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, config_overrides=None):
         super().__init__()
+        self.config_overrides = config_overrides or {}
         self.initUI()
 
     def initUI(self):
@@ -211,7 +225,9 @@ class MainWindow(QMainWindow):
         self.solid_color_window.show()
 
     def on_button2_clicked(self):
-        self.music_reactive_window = MusicReactiveWindow(self, self.read_config())
+        self.music_reactive_window = MusicReactiveWindow(
+            self, {**self.read_config(), **self.config_overrides}
+        )
         self.hide()
         self.music_reactive_window.show()
 
@@ -235,11 +251,9 @@ class SolidColorWindow(QMainWindow):
         super().__init__()
         self.MenuWindow = MenuWindow
         self.initUI()
-        self.serial = ArduinoSerial(
-            port=config.get("arduino_port"),
-            arduino=True if config.get("arduino").lower() == "on" else False,
-        )
+        self.serial = ArduinoSerial.from_config(config)
         self.threadpool = QThreadPool()
+        self.threadpool.start(Worker(self.serial.start_serial))
 
     def initUI(self):
         self.resize(self.MenuWindow.size())
@@ -361,27 +375,106 @@ class SolidColorWindow(QMainWindow):
         return super().closeEvent(event)
 
 
+class SpectrogramWidget(QWidget):
+    def __init__(self, audio, history=256, max_freq=5000, dynamic_range=60):
+        super().__init__()
+        self.audio = audio
+        self.history = history
+        self.max_freq = max_freq
+        self.dynamic_range = dynamic_range
+        cmap = plt.get_cmap("magma")
+        self.color_table = [
+            qRgb(*(int(c * 255) for c in cmap(i)[:3])) for i in range(256)
+        ]
+        self.setMinimumHeight(200)
+        self.clear()
+
+    def clear(self):
+        self.bins = int(np.count_nonzero(self.audio.freqs < self.max_freq))
+        # Every column is written twice, history rows apart, so the last
+        # `history` rows always form one contiguous block ending at the newest
+        # row and can be shown without copying or rolling the buffer.
+        self._buffer = np.zeros((2 * self.history, self.bins), dtype=np.uint8)
+        self._level = np.zeros(self.bins)
+        self._row = 0
+        self._peak = 0.0
+        self._frame_index = self.audio.frame_index
+        self._set_image()
+
+    def _set_image(self):
+        start = self._row + 1
+        self._view = self._buffer[start : start + self.history]
+        self.image = QImage(
+            self._view.data,
+            self.bins,
+            self.history,
+            self.bins,
+            QImage.Format_Indexed8,
+        )
+        self.image.setColorTable(self.color_table)
+
+    def push(self):
+        if self.audio.frame_index == self._frame_index:
+            return
+        self._frame_index = self.audio.frame_index
+        spectrum = self.audio.energy_spectrum
+        if len(self.audio.freqs) != len(spectrum):
+            return
+        if np.count_nonzero(self.audio.freqs < self.max_freq) != self.bins:
+            self.clear()
+
+        level = self._level
+        np.log10(spectrum[: self.bins] + 1e-12, out=level)
+        level *= 10
+        self._peak = max(self._peak - 0.05, level.max())
+        level -= self._peak - self.dynamic_range
+        level *= 255 / self.dynamic_range
+        np.clip(level, 0, 255, out=level)
+
+        self._row = (self._row + 1) % self.history
+        self._buffer[self._row] = level
+        self._buffer[self._row + self.history] = level
+        self._set_image()
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.drawImage(self.rect(), self.image)
+        painter.end()
+
+
 class MusicReactiveWindow(QMainWindow):
     def __init__(self, MenuWindow: QMainWindow, config):
         super().__init__()
         self.MenuWindow = MenuWindow
 
-        self.main_reactive_logic = ReactiveProcessing(
-            arduino_port=config.get("arduino_port"),
-            arduino_on=True if config.get("arduino").lower() == "on" else False,
-            chunk=int(config.get("fft_chunk")),
-            rate=int(config.get("audio_rate")),
-            channel=int(config.get("channel")),
-            device_index=int(config.get("device_index")),
-            energy_range=literal_eval(config.get("energy_range")),
-            reactive=True if config.get("reactive").lower() == "true" else False,
-            reactive_count=int(config.get("reactive_count")),
-            colors=list(literal_eval(config.get("colors")))
-            if type(literal_eval(config.get("colors"))[0]) is tuple
-            else [literal_eval(config.get("colors"))],
-        )
+        if config.get("analysis_source", "local").lower() == "broadcast":
+            self.main_reactive_logic = RemoteAnalysis(
+                config.get("broadcast") or "rgb-features",
+                chunk=int(config.get("fft_chunk")),
+                rate=int(config.get("audio_rate")),
+                energy_range=literal_eval(config.get("energy_range")),
+            )
+        else:
+            self.main_reactive_logic = ReactiveProcessing.from_config(config)
         self.threadpool = QThreadPool()
         self.initUI()
+        self.init_devices()
+
+    def init_devices(self):
+        self.button_start.setEnabled(False)
+        worker = Worker(self.main_reactive_logic.init_devices)
+        worker.signals.finished.connect(self.on_devices_ready)
+        worker.signals.error.connect(self.on_devices_failed)
+        self.threadpool.start(worker)
+
+    def on_devices_ready(self):
+        self.button_start.setEnabled(True)
+
+    def on_devices_failed(self, message):
+        # Start stays disabled, the loop cannot run without its devices.
+        logger.error(f"Devices could not be opened: {message}")
+        self.button_start.setToolTip(f"Devices could not be opened: {message}")
 
     def initUI(self):
         self.resize(self.MenuWindow.size())
@@ -404,10 +497,10 @@ class MusicReactiveWindow(QMainWindow):
         """
         )
 
-        button_start = QPushButton("Start")
-        button_start.setFont(QFont(("Copperplate Gothic Light", 24, QFont.Bold)))
-        button_start.clicked.connect(self.on_button_start_clicked)
-        button_start.setStyleSheet(
+        self.button_start = QPushButton("Start")
+        self.button_start.setFont(QFont(("Copperplate Gothic Light", 24, QFont.Bold)))
+        self.button_start.clicked.connect(self.on_button_start_clicked)
+        self.button_start.setStyleSheet(
             """
             QPushButton {
                 background-color: #000000;
@@ -421,9 +514,12 @@ class MusicReactiveWindow(QMainWindow):
             QPushButton:hover{
                 background-color: #00002a;
             }
+            QPushButton:disabled{
+                color: #555555;
+            }
             """
         )
-        button_start.setFixedSize(button_width, button_height)
+        self.button_start.setFixedSize(button_width, button_height)
 
         button_stop = QPushButton("Stop")
         button_stop.setFont(QFont(("Copperplate Gothic Light", 24, QFont.Bold)))
@@ -446,6 +542,27 @@ class MusicReactiveWindow(QMainWindow):
         )
         button_stop.setFixedSize(button_width, button_height)
 
+        button_profile = QPushButton("Profile")
+        button_profile.setFont(QFont(("Copperplate Gothic Light", 24, QFont.Bold)))
+        button_profile.clicked.connect(self.on_button_profile_clicked)
+        button_profile.setStyleSheet(
+            """
+            QPushButton {
+                background-color: #000000;
+                color: white; 
+                font-weight: bold; 
+                font-size: 24px; 
+                padding: 12px; 
+                border: none; 
+                border-radius: 6px;
+            }
+            QPushButton:hover{
+                background-color: #00002a;
+            }
+            """
+        )
+        button_profile.setFixedSize(button_width, button_height)
+
         back_button = QPushButton("Menu", self)
         back_button.setFixedSize(button_width // 2, button_height // 2)
         back_button.setFont(QFont(("Copperplate Gothic Light", 24, QFont.Bold)))
@@ -474,9 +591,11 @@ class MusicReactiveWindow(QMainWindow):
         button_layout = QHBoxLayout()
         button_layout.setSpacing(0)
         button_layout.setAlignment(Qt.AlignCenter)
-        button_layout.addWidget(button_start, alignment=Qt.AlignCenter)
+        button_layout.addWidget(self.button_start, alignment=Qt.AlignCenter)
         button_layout.addSpacing(20)
         button_layout.addWidget(button_stop, alignment=Qt.AlignCenter)
+        button_layout.addSpacing(20)
+        button_layout.addWidget(button_profile, alignment=Qt.AlignCenter)
 
         label_layout = QVBoxLayout()
         label_layout.addWidget(label, alignment=Qt.AlignCenter)
@@ -489,6 +608,8 @@ class MusicReactiveWindow(QMainWindow):
         plot_layout = QVBoxLayout()
         plot_layout.addWidget(self.toolbar)
         plot_layout.addWidget(self.canvas)
+        self.spectrogram = SpectrogramWidget(self.main_reactive_logic.audio)
+        plot_layout.addWidget(self.spectrogram)
 
         main_layout = QVBoxLayout()
         main_layout.setAlignment(Qt.AlignTop)
@@ -550,8 +671,14 @@ class MusicReactiveWindow(QMainWindow):
         )
 
         def update(frame):
-            y_data1 = self.main_reactive_logic.audio.energy_spectrum[: len(x_data)]
-            y_data2 = self.main_reactive_logic.audio.diff_energy_spectrum[: len(x_data)]
+            audio = self.main_reactive_logic.audio
+            # The frequency bins change when the chunk size is adapted, and the
+            # spectra may briefly still have the old length.
+            x_data = audio.freqs[audio.freqs < 5000]
+            y_data1 = audio.energy_spectrum[: len(x_data)]
+            y_data2 = audio.diff_energy_spectrum[: len(x_data)]
+            if len(y_data1) != len(x_data) or len(y_data2) != len(x_data):
+                return (self.line, self.line2)
             self.line.set_data(x_data, y_data1)
             self.line2.set_data(x_data, y_data2)
             ax1.set_ylim(
@@ -582,6 +709,7 @@ class MusicReactiveWindow(QMainWindow):
             * 1000
         )
         self.timer.add_callback(self.canvas.draw)
+        self.timer.add_callback(self.spectrogram.push)
 
     def on_button_start_clicked(self):
         if not self.main_reactive_logic.running:
@@ -593,6 +721,9 @@ class MusicReactiveWindow(QMainWindow):
     def on_button_stop_clicked(self):
         self.stop()
 
+    def on_button_profile_clicked(self):
+        self.main_reactive_logic.request_profile()
+
     def stop(self):
         self.timer.stop()
         self.main_reactive_logic.stop()
@@ -777,7 +908,28 @@ class SettingsWindow(QMainWindow):
 
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser(description="RGB LED Controller")
+    parser.add_argument(
+        "--profile",
+        type=float,
+        metavar="SECONDS",
+        help="profile the reactive processing thread as soon as it starts",
+    )
+    parser.add_argument("--profile-mode", choices=("cprofile", "sampling"))
+    args, qt_args = parser.parse_known_args()
+    config_overrides = {}
+    if args.profile:
+        config_overrides["profile"] = "ON"
+        config_overrides["profile_duration"] = str(args.profile)
+    if args.profile_mode:
+        config_overrides["profile_mode"] = args.profile_mode
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    metrics_port = int(read_config().get("metrics_port", "0"))
+    if metrics_port:
+        MetricsServer(metrics_port).start()
+    window = MainWindow(config_overrides)
     window.show()
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    AudioStream.terminate()
+    sys.exit(exit_code)
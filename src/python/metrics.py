@@ -0,0 +1,161 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_left
+import threading
+import time
+import logging
+
+# Metrics are updated from several threads (the audio callback, the
+# processing loop, the output scheduler, the GUI and the serial reconnect), so
+# every update and every scrape of a metric holds its lock.
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        super().__init__(name, help)
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.function() if self.function else self.value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        # A consistent snapshot, so _count always matches the buckets.
+        with self.lock:
+            counts, total_sum, count = list(self.counts), self.sum, self.count
+        total = 0
+        for bound, bucket in zip(self.buckets, counts):
+            total += bucket
+            yield f'{self.name}_bucket{{le="{bound}"}}', total
+        yield f'{self.name}_bucket{{le="+Inf"}}', count
+        yield f"{self.name}_sum", total_sum
+        yield f"{self.name}_count", count
+
+
+class Rate:
+    def __init__(self, counter: Counter):
+        self.counter = counter
+        self._last = (time.monotonic(), counter.value)
+
+    def __call__(self):
+        now, value = time.monotonic(), self.counter.value
+        last_time, last_value = self._last
+        self._last = (now, value)
+        return (value - last_value) / (now - last_time) if now > last_time else 0.0
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help, function=None):
+        return self._register(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, help):
+    return registry.counter(name, help)
+
+
+def gauge(name, help, function=None):
+    return registry.gauge(name, help, function)
+
+
+def histogram(name, help, buckets=TIME_BUCKETS):
+    return registry.histogram(name, help, buckets)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, port: int, host: str = "127.0.0.1"):
+        self.server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        MetricsServer.logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
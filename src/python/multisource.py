@@ -0,0 +1,372 @@
+from pyaudio import paFloat32, paContinue, paInputOverflow, paInputUnderflow
+import numpy as np
+from audiostream import AudioStream
+from spectral import create_backend
+from clock import RealClock
+import metrics
+import threading
+import time
+import logging
+
+
+class CaptureInput:
+    logger = logging.getLogger(__name__)
+    resyncs_total = metrics.counter(
+        "audio_source_resyncs_total",
+        "Times an input was realigned after its buffer ran empty or over.",
+    )
+
+    # One capture device. Its callback only appends to a ring; the stream that
+    # owns it reads blocks resampled to the reference device's clock, with the
+    # step adjusted so the fill level of the ring stays at its target.
+    smoothing_seconds = 0.5
+    proportional_gain = 1.5
+    integral_gain = 1.0
+
+    def __init__(self, device_index, rate, channel=1, clock=None, format=paFloat32):
+        self._device_index = device_index
+        self._rate = rate
+        self._channel = channel
+        self._format = format
+        self.rate = rate
+        self.clock = RealClock() if clock is None else clock
+        self.stream = None
+        self.on_block = None
+        self.on_status = None
+        self.overflows = 0
+        self.underflows = 0
+        self.lock = threading.Lock()
+        self.configure(512, 512, rate)
+
+    def configure(self, hop: int, count: int, reference_rate: float):
+        # `hop` samples arrive per callback, `count` are read per block.
+        self._hop = hop
+        self.period = hop / self.rate
+        self.reference_rate = reference_rate
+        self.ring = np.zeros(max(16 * hop, int(self.rate)), dtype=np.float32)
+        self._steps = np.arange(count, dtype=np.float64)
+        self._positions = np.zeros(count)
+        self._fraction = np.zeros(count)
+        self._index = np.zeros(count, dtype=np.int64)
+        self._left = np.zeros(count, dtype=np.float32)
+        self._smoothing = min(count / reference_rate / self.smoothing_seconds, 1.0)
+        self.reset()
+
+    def reset(self):
+        self.ring[:] = 0
+        self.written = 0
+        self.arrived = None
+        self.cursor = 0.0
+        self.delay = 0.0
+        self.target = 0.0
+        self.level = 0.0
+        self.integral = 0.0
+        self.nominal = self.rate / self.reference_rate
+        self.ratio = self.nominal
+
+    def open_stream(self):
+        if self.stream is None:
+            self.stream = AudioStream.get_pyaudio().open(
+                format=self._format,
+                channels=self._channel,
+                rate=self._rate,
+                input=True,
+                frames_per_buffer=self._hop,
+                input_device_index=self._device_index,
+                stream_callback=self._procces_stream,
+                start=False,
+            )
+
+    def start_stream(self):
+        self.open_stream()
+        if self.stream.is_stopped():
+            self.stream.start_stream()
+
+    def stop_stream(self):
+        if self.stream is not None and self.stream.is_active():
+            self.stream.stop_stream()
+
+    def close_stream(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+
+    def latency(self):
+        return self.stream.get_input_latency() if self.stream is not None else 0.0
+
+    def drift(self):
+        # Estimated clock drift against the reference, in parts per million.
+        return (self.ratio / self.nominal - 1) * 1e6
+
+    def _procces_stream(self, in_data, frame_count, time_info, status_flag):
+        if status_flag & (paInputOverflow | paInputUnderflow):
+            if status_flag & paInputOverflow:
+                self.overflows += 1
+            if status_flag & paInputUnderflow:
+                self.underflows += 1
+            if self.on_status is not None:
+                self.on_status(self, status_flag)
+        block = np.frombuffer(in_data, dtype=np.float32)
+        if self._channel > 1:
+            block = block.reshape(-1, self._channel).mean(axis=1)
+        start = self.written % len(self.ring)
+        stop = min(start + len(block), len(self.ring))
+        self.ring[start:stop] = block[: stop - start]
+        self.ring[: len(block) - (stop - start)] = block[stop - start :]
+        with self.lock:
+            self.written += len(block)
+            self.arrived = self.clock.time()
+        if self.on_block is not None:
+            self.on_block()
+        return (in_data, paContinue)
+
+    def position(self, now: float):
+        # Samples captured by `now`, extrapolated from the last callback so
+        # the position does not jump by a whole buffer at each callback.
+        with self.lock:
+            written, arrived = self.written, self.arrived
+        if arrived is None:
+            return float(written)
+        return written + min(max(now - arrived, 0.0), self.period) * self.rate
+
+    def align(self, now: float, delay: float):
+        # Start reading `delay` seconds behind the latest captured sample.
+        self.delay = delay
+        self.target = delay * self.rate
+        self.cursor = self.position(now) - self.target
+        self.level = self.target
+
+    def read_into(self, now: float, out):
+        if self.arrived is None:
+            out[:] = 0
+            return
+        count = len(out)
+        position = self.position(now)
+        self.level += self._smoothing * (position - self.cursor - self.level)
+        # The target is in samples of the input's own clock, so that `delay`
+        # means the same moment on every input.
+        self.target = self.delay * self.reference_rate * self.ratio
+        error = (self.level - self.target) / self.rate
+        self.integral += error * count / self.reference_rate
+        self.ratio = self.nominal * (
+            1 + self.proportional_gain * error + self.integral_gain * self.integral
+        )
+        end = self.cursor + self.ratio * count
+        if (
+            end >= self.written
+            or self.written - self.cursor > len(self.ring) - self._hop
+        ):
+            CaptureInput.logger.debug(
+                f"Input {self._device_index} realigned, buffer level "
+                f"{position - self.cursor:.0f} samples."
+            )
+            CaptureInput.resyncs_total.inc()
+            self.align(now, self.delay)
+            end = self.cursor + self.ratio * count
+        # Linear interpolation between ring samples, as np.interp would do,
+        # into preallocated buffers.
+        np.multiply(self._steps, self.ratio, out=self._positions)
+        self._positions += self.cursor
+        np.floor(self._positions, out=self._fraction)
+        np.copyto(self._index, self._fraction, casting="unsafe")
+        np.subtract(self._positions, self._fraction, out=self._fraction)
+        np.take(self.ring, self._index, out=self._left, mode="wrap")
+        self._index += 1
+        np.take(self.ring, self._index, out=out, mode="wrap")
+        out -= self._left
+        out *= self._fraction
+        out += self._left
+        self.cursor = end
+
+
+class SourceSpectra:
+    # Spectral backend that analyses every aligned input on its own and sums
+    # the power spectra, so inputs picking up the same sound at different
+    # distances do not comb-filter as they would in a mix.
+    def __init__(self, owner, backends, bins: int):
+        self.owner = owner
+        self.backends = backends
+        self.spectra = np.zeros((len(backends), bins))
+
+    def skip(self, block):
+        for backend, source_block in zip(self.backends, self.owner.blocks):
+            backend.skip(source_block)
+
+    def spectrum(self, block, out):
+        for backend, source_block, spectrum in zip(
+            self.backends, self.owner.blocks, self.spectra
+        ):
+            backend.spectrum(source_block, spectrum)
+        self.spectra.sum(axis=0, out=out)
+
+
+class MultiSourceStream(AudioStream):
+    logger = logging.getLogger(__name__)
+
+    # Captures from several devices. The first one is the reference: each of
+    # its callbacks reads one aligned block from every input, mixes them (or
+    # analyses them separately, mode "separate") and runs the analysis.
+    def __init__(
+        self,
+        chunk,
+        channel,
+        rate,
+        device_index,
+        mode="mix",
+        gains=None,
+        inputs=None,
+        **kwargs,
+    ):
+        if mode not in ("mix", "separate"):
+            raise ValueError(f"Unknown source mode: {mode}")
+        self.mode = mode
+        clock = kwargs.get("clock")
+        kwargs["clock"] = RealClock() if clock is None else clock
+        self.inputs = (
+            inputs
+            if inputs is not None
+            else [
+                CaptureInput(index, rate, channel, kwargs["clock"])
+                for index in device_index
+            ]
+        )
+        if not self.inputs:
+            raise ValueError("At least one input device is needed.")
+        self.gains = (
+            np.ones(len(self.inputs)) if gains is None else np.asarray(gains, float)
+        )
+        self.source_spectra = None
+        self._delay = 0.0
+        # Every input reports its overflows from its own callback thread.
+        self._status_lock = threading.Lock()
+        super().__init__(chunk, channel, rate, None, **kwargs)
+
+    def _allocate(self, chunk):
+        super()._allocate(chunk)
+        self.blocks = np.zeros((len(self.inputs), self._hop), dtype=np.float32)
+        self.mix = np.zeros(self._hop, dtype=np.float32)
+        # Separate analysis needs every input's block to be reproduced.
+        self._recorded = (
+            self.blocks.reshape(-1) if self.mode == "separate" else self.mix
+        )
+        for source in self.inputs:
+            source.configure(
+                round(self._hop * source.rate / self._rate), self._hop, self._rate
+            )
+        self._aligned = False
+
+    def set_bands(self, count, fmin, fmax, scale="log"):
+        super().set_bands(count, fmin, fmax, scale)
+        if self.mode == "separate":
+            backends = [
+                create_backend(
+                    self._backend_name,
+                    self._chunk,
+                    self._hop,
+                    self.filterbank.starts[0],
+                    self.filterbank.stops[-1],
+                )
+                for _ in self.inputs
+            ]
+            self.backend = SourceSpectra(self, backends, len(self.freqs))
+            self.source_spectra = self.backend.spectra
+
+    def open_stream(self):
+        if self.stream is None:
+            for source in self.inputs:
+                source.open_stream()
+                source.on_status = self._input_status
+            self.inputs[0].on_block = self._deliver
+            self.stream = self.inputs[0].stream
+            MultiSourceStream.logger.info(
+                f"Audio streams for {len(self.inputs)} inputs have been initialized."
+            )
+
+    def start_stream(self):
+        self.open_stream()
+        if self.stream.is_stopped():
+            MultiSourceStream.logger.info(
+                "Audio streams have opened. * Started recording."
+            )
+            self._aligned = False
+            # The reference starts last, so the others already have data.
+            for source in self.inputs[::-1]:
+                source.reset()
+                source.start_stream()
+
+    def stop_stream(self):
+        for source in self.inputs:
+            source.stop_stream()
+        if self._aligned and len(self.inputs) > 1:
+            self._aligned = False
+            drifts = ", ".join(f"{source.drift():+.0f}" for source in self.inputs[1:])
+            MultiSourceStream.logger.info(
+                f"Audio streams have stopped, input clock drift {drifts} ppm."
+            )
+
+    def close_stream(self):
+        if self.stream is not None:
+            for source in self.inputs:
+                source.close_stream()
+            self.stream = None
+            MultiSourceStream.logger.info("Audio streams have closed.")
+
+    def record_layout(self):
+        if self.mode == "separate":
+            return self.blocks.size, {
+                "source_mode": self.mode,
+                "inputs": len(self.inputs),
+            }
+        return self._hop, {}
+
+    def input_latency(self):
+        # Every input is read this far behind its capture, see _align.
+        if not self._aligned:
+            return 3 * self._hop / self._rate + max(s.latency() for s in self.inputs)
+        return self._delay
+
+    def _align(self, now):
+        # Inputs with less latency are read further behind, so blocks from
+        # all inputs cover the same moment. Extrapolated positions can run a
+        # hop ahead of the data, hence three hops of margin.
+        latencies = [source.latency() for source in self.inputs]
+        self._delay = 3 * self._hop / self._rate + max(latencies)
+        for source, latency in zip(self.inputs, latencies):
+            source.align(now, self._delay - latency)
+        self._aligned = True
+
+    def _input_status(self, source, status_flag):
+        # Any input dropping samples counts against the stream, as
+        # adapt_chunk reads it.
+        with self._status_lock:
+            if status_flag & paInputOverflow:
+                self.input_overflows += 1
+                AudioStream.overflows_total.inc()
+                MultiSourceStream.logger.debug(
+                    f"Audio input {source._device_index} overflow."
+                )
+            if status_flag & paInputUnderflow:
+                self.input_underflows += 1
+                AudioStream.underflows_total.inc()
+                MultiSourceStream.logger.debug(
+                    f"Audio input {source._device_index} underflow."
+                )
+
+    def _deliver(self):
+        started = time.perf_counter()
+        now = self.clock.time()
+        if not self._aligned:
+            self._align(now)
+        for source, block, gain in zip(self.inputs, self.blocks, self.gains):
+            source.read_into(now, block)
+            if gain != 1:
+                block *= gain
+        self.blocks.sum(axis=0, out=self.mix)
+        with self.frame_lock:
+            self.process(self.mix)
+            if self.recorder is not None:
+                self.recorder.add_frame(self.frame_index, self._recorded, now)
+        self.callback_time = time.perf_counter() - started
+        AudioStream.frames_total.inc()
+        AudioStream.callback_seconds.observe(self.callback_time)
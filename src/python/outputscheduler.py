@@ -0,0 +1,132 @@
+import threading
+import time
+import logging
+
+import numpy as np
+
+EASING_CURVES = {
+    "linear": lambda u: u,
+    "ease-in": lambda u: u**2,
+    "ease-out": lambda u: 1 - (1 - u) ** 2,
+    "smooth": lambda u: u * u * (3 - 2 * u),
+    "exponential": lambda u: (1 - np.exp(-5 * u)) / (1 - np.exp(-5)),
+}
+
+
+def easing_table(curve: str, seconds: float, refresh_rate: float):
+    # Weight of the new value at each tick after it arrived, from the first
+    # tick to the one that completes the transition.
+    if curve not in EASING_CURVES:
+        raise ValueError(f"Unknown easing curve: {curve}")
+    ticks = max(int(round(seconds * refresh_rate)), 1)
+    return EASING_CURVES[curve](np.arange(1, ticks + 1) / ticks)
+
+
+class OutputScheduler:
+    logger = logging.getLogger(__name__)
+
+    # Writes to the output at its own refresh rate and eases from the value
+    # on the strip to the latest analysis value, so the LEDs move smoothly
+    # whatever the hop. Ticks stop once a transition has settled.
+    def __init__(
+        self,
+        serial,
+        clock,
+        refresh_rate: float,
+        shape=(3,),
+        attack: float = 0.02,
+        decay: float = 0.15,
+        attack_curve: str = "ease-out",
+        decay_curve: str = "exponential",
+    ):
+        self.serial = serial
+        self.clock = clock
+        self.refresh_rate = refresh_rate
+        self.period = 1 / refresh_rate
+        self._attack = easing_table(attack_curve, attack, refresh_rate)
+        self._decay = easing_table(decay_curve, decay, refresh_rate)
+        self._settle_ticks = max(len(self._attack), len(self._decay))
+        self._start = np.zeros(shape)
+        self._delta = np.zeros(shape)
+        self._value = np.zeros(shape)
+        self._weight = np.zeros(shape)
+        self._rising = np.zeros(shape, dtype=bool)
+        self._sent = np.zeros(shape, dtype=np.uint8)
+        self._rounded = np.zeros(shape)
+        self._frame = np.zeros(shape, dtype=np.uint8)
+        self._changed = 0.0
+        self._next = 0.0
+        self._pending = None
+        self._running = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.write_time = 0.0
+
+    def start(self):
+        with self._lock:
+            self._running = True
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            if self._pending is not None:
+                self._pending.cancel()
+                self._pending = None
+        # Wait for a write in progress, nothing is written after this returns.
+        with self._write_lock:
+            pass
+
+    def delay(self):
+        # Average wait for the next tick plus the time a write takes.
+        return self.period / 2 + self.write_time
+
+    def update(self, target):
+        with self._lock:
+            np.copyto(self._start, self._value)
+            np.subtract(target, self._start, out=self._delta)
+            np.greater(self._delta, 0, out=self._rising)
+            self._changed = self.clock.time()
+            if self._running and self._pending is None:
+                self._next = self._changed + self.period
+                self._pending = self.clock.call_at(self._next, self._tick)
+
+    def _tick(self):
+        with self._lock:
+            if not self._running:
+                return
+            ticks = max(
+                int(round((self.clock.time() - self._changed) * self.refresh_rate)), 1
+            )
+            np.copyto(self._weight, self._decay[min(ticks, len(self._decay)) - 1])
+            np.copyto(
+                self._weight,
+                self._attack[min(ticks, len(self._attack)) - 1],
+                where=self._rising,
+            )
+            np.multiply(self._delta, self._weight, out=self._value)
+            self._value += self._start
+            np.rint(self._value, out=self._rounded)
+            np.copyto(self._frame, self._rounded, casting="unsafe")
+            changed = not np.array_equal(self._frame, self._sent)
+            if changed:
+                np.copyto(self._sent, self._frame)
+                frame = self._frame.copy()
+            if ticks >= self._settle_ticks:
+                self._pending = None
+            else:
+                # Deadlines stay on the tick grid unless the clock fell behind.
+                self._next = max(self._next + self.period, self.clock.time())
+                self._pending = self.clock.call_at(self._next, self._tick)
+        if changed:
+            self._write(frame)
+
+    def _write(self, frame):
+        with self._write_lock:
+            if not self._running:
+                return
+            started = time.perf_counter()
+            if frame.ndim == 1:
+                self.serial.communicate(tuple(frame.tolist()))
+            else:
+                self.serial.communicate_frame(frame)
+            self.write_time += 0.1 * (time.perf_counter() - started - self.write_time)
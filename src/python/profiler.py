@@ -0,0 +1,120 @@
+from collections import Counter
+import cProfile
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import logging
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval: float = 0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._running = False
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def _sample(self):
+        while self._running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                    f"{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def dump(self, path):
+        # Collapsed stacks, the input format of flamegraph tools.
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileSession:
+    logger = logging.getLogger(__name__)
+    sessions = 0
+
+    def __init__(self, duration: float, directory: str, mode: str = "cprofile"):
+        if mode not in ("cprofile", "sampling"):
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.duration = duration
+        self.directory = directory
+        self.mode = mode
+        self.frames = 0
+        self._allocated = 0
+
+    def start(self):
+        # Must be called from the thread that should be profiled.
+        os.makedirs(self.directory, exist_ok=True)
+        # Milliseconds and a session counter keep quick successive dumps apart.
+        ProfileSession.sessions += 1
+        now = time.time()
+        self.path = os.path.join(
+            self.directory,
+            time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(now))
+            + f"-{int(now * 1000) % 1000:03d}-{ProfileSession.sessions}",
+        )
+        tracemalloc.start()
+        self._start_snapshot = tracemalloc.take_snapshot()
+        self._frame_memory = tracemalloc.get_traced_memory()[0]
+        if self.mode == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler = StackSampler(threading.get_ident())
+            self._profiler.start()
+        self._deadline = time.perf_counter() + self.duration
+        ProfileSession.logger.info(
+            f"Profiling the processing thread for {self.duration}s ({self.mode})."
+        )
+
+    def frame_done(self):
+        self.frames += 1
+        # reset_peak only exists on Python 3.9+, older versions skip the
+        # per-frame figure.
+        if hasattr(tracemalloc, "reset_peak"):
+            current, peak = tracemalloc.get_traced_memory()
+            self._allocated += peak - self._frame_memory
+            tracemalloc.reset_peak()
+            self._frame_memory = current
+        return self.expired()
+
+    def expired(self):
+        return time.perf_counter() >= self._deadline
+
+    def stop(self):
+        if self.mode == "cprofile":
+            self._profiler.disable()
+            self._profiler.dump_stats(f"{self.path}.prof")
+        else:
+            self._profiler.stop()
+            self._profiler.dump(f"{self.path}.folded")
+
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(f"{self.path}.tracemalloc")
+        with open(f"{self.path}-allocations.txt", "w") as f:
+            per_frame = self._allocated / self.frames if self.frames else 0
+            f.write(
+                f"{self.frames} frames, {per_frame:.0f} bytes peak allocation "
+                f"per frame\n\nTop allocation growth during the session:\n"
+            )
+            for stat in snapshot.compare_to(self._start_snapshot, "lineno")[:25]:
+                f.write(f"{stat}\n")
+        ProfileSession.logger.info(f"Profile written to {self.path}.*")
@@ -1,14 +1,58 @@
 from arduinoserial import ArduinoSerial
 from audiostream import AudioStream
+from multisource import MultiSourceStream
 from rgbcolor import RgbColor
+from recorder import FrameRecorder
+from chunkcontroller import ChunkController
+from effects import create_effect
+from profiler import ProfileSession
+from broadcast import FeatureServer
+from tempo import TempoTracker
+from outputscheduler import OutputScheduler
+from clock import RealClock
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from ast import literal_eval
 import numpy as np
+import json
 import math
+import os
+import threading
 import time
 import logging
 
 
+def read_config(path=None):
+    if path is None:
+        path = f"{os.path.dirname(os.path.realpath(__file__))}/config.json"
+    with open(path, "r") as f:
+        return json.load(f)
+
+
 class ReactiveProcessing:
     logger = logging.getLogger(__name__)
+    frames_total = metrics.counter(
+        "analysis_frames_total", "Frames processed by the reactive loop."
+    )
+    dropped_frames_total = metrics.counter(
+        "analysis_dropped_frames_total",
+        "Audio frames that arrived but were never processed by the reactive loop.",
+    )
+    step_seconds = metrics.histogram(
+        "analysis_step_seconds", "Time spent computing the color for one frame."
+    )
+    fps = metrics.gauge(
+        "analysis_fps",
+        "Frames processed per second since the previous scrape.",
+        metrics.Rate(frames_total),
+    )
+    idle_seconds_total = metrics.counter(
+        "analysis_idle_seconds_total", "Time the loop spent idle on silent input."
+    )
+    idle_cpu_seconds_total = metrics.counter(
+        "analysis_idle_cpu_seconds_total", "Process CPU time used while idle."
+    )
 
     def __init__(
         self,
@@ -22,15 +66,101 @@ class ReactiveProcessing:
         reactive: bool,
         reactive_count: int,
         colors: list,
-        **kwargs
+        band_count: int = 3,
+        band_scale: str = "log",
+        band_range: list = (80, 1600),
+        record_path: str = "",
+        adaptive_chunk: bool = False,
+        chunk_range: list = (512, 8192),
+        effect: str = "solid",
+        pixel_count: int = 1,
+        serial_encoding: str = "auto",
+        profile: bool = False,
+        profile_mode: str = "cprofile",
+        profile_duration: float = 10.0,
+        profile_dir: str = "profiles",
+        broadcast: str = "",
+        spectral_backend: str = "fft",
+        spectral_hop: int = 0,
+        silence_gate: bool = False,
+        silence_threshold: float = -60.0,
+        silence_hold: float = 1.0,
+        idle_rate: float = 4.0,
+        hpss: bool = False,
+        hpss_frames: int = 17,
+        hpss_width: int = 17,
+        tempo: bool = False,
+        tempo_confidence: float = 0.3,
+        output_latency_ms: float = 10.0,
+        led_refresh_rate: float = 0,
+        led_attack_ms: float = 20,
+        led_decay_ms: float = 150,
+        led_attack_curve: str = "ease-out",
+        led_decay_curve: str = "exponential",
+        device_indices: list = (),
+        source_mode: str = "mix",
+        clock=None,
+        audio_source=AudioStream,
+        output=ArduinoSerial,
+        **kwargs,
     ) -> None:
-        self.serial = ArduinoSerial(port=arduino_port, arduino=arduino_on)
-        self.audio = AudioStream(
+        self.config = {
+            "chunk": chunk,
+            "channel": channel,
+            "rate": rate,
+            "energy_range": list(energy_range),
+            "reactive": reactive,
+            "reactive_count": reactive_count,
+            "colors": colors,
+            "band_count": band_count,
+            "band_scale": band_scale,
+            "band_range": list(band_range),
+            "spectral_backend": spectral_backend,
+            "spectral_hop": spectral_hop,
+            "silence_gate": silence_gate,
+            "silence_threshold": silence_threshold,
+            "silence_hold": silence_hold,
+            "hpss": hpss,
+            "hpss_frames": hpss_frames,
+            "hpss_width": hpss_width,
+            "tempo": tempo,
+            "tempo_confidence": tempo_confidence,
+            "output_latency_ms": output_latency_ms,
+        }
+        # The clock, audio source and output are injectable so the loop can run
+        # against simulated devices, see simulation.py.
+        self.clock = RealClock() if clock is None else clock
+        self.serial = output(
+            port=arduino_port,
+            arduino=arduino_on,
+            pixels=pixel_count,
+            encoding=serial_encoding,
+        )
+        if device_indices and audio_source is AudioStream:
+            audio_source = partial(MultiSourceStream, mode=source_mode)
+            device_index = list(device_indices)
+        self.audio = audio_source(
             chunk=chunk,
             channel=channel,
             rate=rate,
             device_index=device_index,
+            backend=spectral_backend,
+            hop=spectral_hop or None,
+            clock=self.clock,
         )
+        self.audio.set_bands(band_count, *band_range, band_scale)
+        if hpss:
+            self.audio.set_hpss(hpss_frames, hpss_width)
+        self.audio.set_silence_gate(
+            silence_threshold if silence_gate else None, silence_hold
+        )
+        self.idle_rate = idle_rate
+        self.tempo_confidence = tempo_confidence
+        self.tempo = self.create_tempo_tracker() if tempo else None
+        self.output_delay = output_latency_ms / 1000
+        self.output_time = 0.0
+        self.step_latency = 0.0
+        self._active_time = self._active_cpu = 0.0
 
         self.freq_range = (0, 400)
         self.energy_range = energy_range
@@ -40,72 +170,401 @@ class ReactiveProcessing:
         self.default_energy = self.energy_range[1]
         self.energy_sum = self.energy_range[1]
         self.energy_samples = 1
+        self.reset_categories(self.clock.time())
+        self.record_path = record_path
+        self.chunk_controller = (
+            ChunkController(chunk, *chunk_range) if adaptive_chunk else None
+        )
+        self.effect = (
+            create_effect(effect, pixel_count, band_count)
+            if effect != "solid"
+            else None
+        )
+        self.frame = None
+        # With a refresh rate the strip is written from the clock's thread
+        # and eased between analysis frames; 0 writes once per frame.
+        self.scheduler = (
+            OutputScheduler(
+                self.serial,
+                self.clock,
+                led_refresh_rate,
+                shape=(3,) if self.effect is None else (pixel_count, 3),
+                attack=led_attack_ms / 1000,
+                decay=led_decay_ms / 1000,
+                attack_curve=led_attack_curve,
+                decay_curve=led_decay_curve,
+            )
+            if led_refresh_rate > 0
+            else None
+        )
+        self.profile_mode = profile_mode
+        self.profile_duration = profile_duration
+        self.profile_dir = profile_dir
+        self.profile_request = profile_duration if profile else 0
+        self.profile_session = None
+        self.broadcast = broadcast
+        self.feature_server = None
+        self.dominant_freq = 0.0
         self.running = False
+        self.ready = threading.Event()
+        self._init_futures = None
+        self._init_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict, **overrides):
+        colors = literal_eval(config.get("colors"))
+        kwargs = dict(
+            arduino_port=config.get("arduino_port"),
+            arduino_on=True if config.get("arduino").lower() == "on" else False,
+            chunk=int(config.get("fft_chunk")),
+            rate=int(config.get("audio_rate")),
+            channel=int(config.get("channel")),
+            device_index=int(config.get("device_index")),
+            energy_range=literal_eval(config.get("energy_range")),
+            reactive=True if config.get("reactive").lower() == "true" else False,
+            reactive_count=int(config.get("reactive_count")),
+            colors=list(colors) if type(colors[0]) is tuple else [colors],
+            band_count=int(config.get("band_count", "3")),
+            band_scale=config.get("band_scale", "log"),
+            band_range=literal_eval(config.get("band_range", "[80, 1600]")),
+            record_path=config.get("record_path", ""),
+            adaptive_chunk=config.get("adaptive_chunk", "OFF").lower() == "on",
+            chunk_range=literal_eval(config.get("chunk_range", "[512, 8192]")),
+            effect=config.get("effect", "solid").lower(),
+            pixel_count=int(config.get("pixel_count", "1")),
+            serial_encoding=config.get("serial_encoding", "auto").lower(),
+            profile=config.get("profile", "OFF").lower() == "on",
+            profile_mode=config.get("profile_mode", "cprofile"),
+            profile_duration=float(config.get("profile_duration", "10")),
+            profile_dir=config.get("profile_dir", "profiles"),
+            broadcast=config.get("broadcast", ""),
+            spectral_backend=config.get("spectral_backend", "fft").lower(),
+            spectral_hop=int(config.get("spectral_hop", "0")),
+            silence_gate=config.get("silence_gate", "OFF").lower() == "on",
+            silence_threshold=float(config.get("silence_threshold", "-60")),
+            silence_hold=float(config.get("silence_hold", "1")),
+            idle_rate=float(config.get("idle_rate", "4")),
+            hpss=config.get("hpss", "OFF").lower() == "on",
+            hpss_frames=int(config.get("hpss_frames", "17")),
+            hpss_width=int(config.get("hpss_width", "17")),
+            tempo=config.get("tempo", "OFF").lower() == "on",
+            tempo_confidence=float(config.get("tempo_confidence", "0.3")),
+            output_latency_ms=float(config.get("output_latency_ms", "10")),
+            led_refresh_rate=float(config.get("led_refresh_rate", "0")),
+            led_attack_ms=float(config.get("led_attack_ms", "20")),
+            led_decay_ms=float(config.get("led_decay_ms", "150")),
+            led_attack_curve=config.get("led_attack_curve", "ease-out").lower(),
+            led_decay_curve=config.get("led_decay_curve", "exponential").lower(),
+            device_indices=literal_eval(config.get("device_indices", "[]")),
+            source_mode=config.get("source_mode", "mix").lower(),
+        )
+        kwargs.update(overrides)
+        if kwargs["effect"] != "solid" and kwargs["pixel_count"] < 2:
+            # Effects send multi-pixel frames, which a single-pixel sketch
+            # would read as colors.
+            raise ValueError(
+                f"The {kwargs['effect']} effect needs pixel_count of at least 2."
+            )
+        return cls(**kwargs)
+
+    def init_devices(self):
+        with self._init_lock:
+            if self._init_futures is None:
+                ReactiveProcessing.logger.info("Initializing serial and audio devices.")
+                executor = ThreadPoolExecutor(max_workers=2)
+                self._init_futures = [
+                    executor.submit(self.serial.start_serial),
+                    executor.submit(self.audio.open_stream),
+                ]
+                executor.shutdown(wait=False)
+        for future in self._init_futures:
+            future.result()
+        if not self.ready.is_set():
+            ReactiveProcessing.logger.info("Serial and audio devices are ready.")
+            self.ready.set()
 
     def start(self):
+        self.init_devices()
         ReactiveProcessing.logger.info("Main logic for reactive leds started.")
         self.running = True
         self.serial.start_serial()
+        if self.scheduler is not None:
+            self.scheduler.start()
         self.audio.start_stream()
-        freq_categories = {
-            "bass": {"range": (80, 400), "count": 0},
-            "mid": {"range": (400, 1000), "count": 0},
-            "high": {"range": (1000, 1600), "count": 0},
-        }
-
-        prev_time = time.time()
-        freq_ranges = [freq_categories[cat]["range"] for cat in freq_categories.keys()]
+        self.reset_categories(self.clock.time())
+        recorder = self.open_recorder()
+        if self.broadcast and self.feature_server is None:
+            self.feature_server = FeatureServer(self.broadcast)
+        # Records have a fixed size, so the chunk cannot change while recording.
+        chunk_controller = self.chunk_controller if recorder is None else None
 
+        last_frame_index = self.audio.frame_index
+        idle = None
+        active = (time.perf_counter(), time.process_time())
         while self.running:
-            freq_energy_list = self.audio.get_max_diff_freq_energy(freq_ranges)
-            dfmax, demax = max(freq_energy_list, key=lambda x: x[1])
-            index_max = freq_energy_list.index((dfmax, demax))
-            category = list(freq_categories.keys())[index_max]
-            freq_categories[category]["count"] += 1 if demax > 0 else 0
-            max_range = max(freq_categories.items(), key=lambda x: x[1]["count"])[1][
-                "range"
-            ]
-            dfmax, demax = freq_energy_list[freq_ranges.index(max_range)]
-            self.freq_range = max_range
-            self.energy_sum += demax
-            self.energy_samples += 1
-            self.energy_range[1] = self.energy_sum / self.energy_samples
-            power = self.generate_power(demax)
-            if power == 0:
-                self.energy_sum = self.default_energy
-                self.energy_samples = 1
-            if time.time() - prev_time > 5:
-                max_cat = "bass"
-                maxi = -1
-                for cat in freq_categories.keys():
-                    if freq_categories[cat]["count"] > maxi:
-                        maxi = freq_categories[cat]["count"]
-                        max_cat = cat
-                    freq_categories[cat]["count"] = 0
-
-                freq_categories[max_cat]["count"] += 1
-                prev_time = time.time()
-            frange, color = self.search_range(dfmax, self.generate_color_range())
-            color = color.power(power)
-            self.serial.communicate(color.rgb)
-            time.sleep(self.audio._chunk / self.audio._rate)
+            if self.profile_request and self.profile_session is None:
+                self.start_profile()
+            if self.audio.silent:
+                if idle is None:
+                    idle = self.enter_idle(active)
+                if self.profile_session is not None and self.profile_session.expired():
+                    self.stop_profile()
+                # The audio callback sets the event on the first loud block,
+                # so the loop resumes within one hop.
+                self.clock.wait(self.audio.sound, 1 / self.idle_rate)
+                continue
+            if idle is not None:
+                active = self.leave_idle(idle)
+                idle = None
+                last_frame_index = self.audio.frame_index - 1
+            now = self.clock.time()
+            started = time.perf_counter()
+            # No block is analysed during the step, so the step and its
+            # record belong to the frame read here.
+            with self.audio.frame_lock:
+                frame_index = self.audio.frame_index
+                state = self.get_state() if recorder is not None else None
+                color, power = self.step(now)
+            if frame_index - last_frame_index > 1:
+                ReactiveProcessing.dropped_frames_total.inc(
+                    frame_index - last_frame_index - 1
+                )
+            last_frame_index = frame_index
+            ReactiveProcessing.step_seconds.observe(time.perf_counter() - started)
+            ReactiveProcessing.frames_total.inc()
+            if recorder is not None:
+                recorder.add_step(
+                    frame_index, now, state, color.rgb, power, self.step_latency
+                )
+            if self.feature_server is not None:
+                self.feature_server.publish(self, color, power, now)
+            self.output(color)
+            if chunk_controller is not None:
+                self.adapt_chunk(chunk_controller, time.perf_counter() - started)
+            if self.profile_session is not None and self.profile_session.frame_done():
+                self.stop_profile()
+            self.clock.sleep(self.audio._hop / self.audio._rate)
         else:
+            if idle is not None:
+                self.leave_idle(idle)
+            if self.profile_session is not None:
+                self.stop_profile()
+            if self.audio.input_overflows or self.audio.input_underflows:
+                ReactiveProcessing.logger.warning(
+                    f"{self.audio.input_overflows} audio input overflows and "
+                    f"{self.audio.input_underflows} underflows so far."
+                )
             try:
                 self.audio.stop_stream()
+                self.audio.recorder = None
+                if recorder is not None:
+                    recorder.close()
+                if self.scheduler is not None:
+                    self.scheduler.stop()
                 self.serial.close_serial()
                 self.serial.communicate((0, 0, 0))
             except:
                 pass
 
+    def enter_idle(self, active):
+        # A single blackout frame, then no serial traffic until sound returns.
+        if self.scheduler is not None:
+            self.scheduler.update(0)
+        else:
+            self.serial.communicate((0, 0, 0))
+        if self.feature_server is not None:
+            # Subscribers get the blackout too, nothing is published while idle.
+            self.feature_server.publish(
+                self, RgbColor(rgb=(0, 0, 0)), 0, self.clock.time()
+            )
+        idle = (time.perf_counter(), time.process_time())
+        self._active_time += idle[0] - active[0]
+        self._active_cpu += idle[1] - active[1]
+        ReactiveProcessing.logger.info("Input is silent, reactive loop idling.")
+        return idle
+
+    def leave_idle(self, idle):
+        active = (time.perf_counter(), time.process_time())
+        idle_time, idle_cpu = active[0] - idle[0], active[1] - idle[1]
+        ReactiveProcessing.idle_seconds_total.inc(idle_time)
+        ReactiveProcessing.idle_cpu_seconds_total.inc(idle_cpu)
+        # Compare against the CPU load of the process while it was analysing.
+        active_load = self._active_cpu / self._active_time if self._active_time else 0
+        idle_load = idle_cpu / idle_time if idle_time else 0
+        saved = max(active_load * idle_time - idle_cpu, 0)
+        ReactiveProcessing.logger.info(
+            f"Idle for {idle_time:.1f}s at {idle_load * 100:.1f}% CPU "
+            f"({active_load * 100:.1f}% while active), "
+            f"saved about {saved:.2f} CPU seconds."
+        )
+        return active
+
+    def request_profile(self, duration=None):
+        if self.profile_session is not None:
+            ReactiveProcessing.logger.info(
+                "A profile is already running, the request is ignored."
+            )
+            return
+        self.profile_request = duration or self.profile_duration
+
+    def start_profile(self):
+        self.profile_session = ProfileSession(
+            self.profile_request, self.profile_dir, self.profile_mode
+        )
+        self.profile_request = 0
+        self.profile_session.start()
+
+    def stop_profile(self):
+        self.profile_session.stop()
+        self.profile_session = None
+
+    def output(self, color):
+        started = time.perf_counter()
+        if self.effect is not None:
+            self.frame = self.effect.render(
+                self.audio.band_energy, self.audio.band_diff, color.rgb
+            )
+        if self.scheduler is not None:
+            self.scheduler.update(color.rgb if self.effect is None else self.frame)
+        elif self.effect is None:
+            self.serial.communicate(color.rgb)
+        else:
+            self.serial.communicate_frame(self.frame)
+        self.output_time += 0.1 * (time.perf_counter() - started - self.output_time)
+
+    def output_latency(self):
+        # From a beat in the input to light on the strip: input buffering,
+        # on average half a hop until the block holding the onset is
+        # delivered, about a quarter window before the rise shows through the
+        # Hann taper, then the serial write and the delay of the strip.
+        audio = self.audio
+        return (
+            audio.input_latency()
+            + (audio._hop / 2 + audio._chunk / 4) / audio._rate
+            + self.output_time
+            + (self.scheduler.delay() if self.scheduler is not None else 0)
+            + self.output_delay
+        )
+
+    def create_tempo_tracker(self):
+        return TempoTracker(
+            self.audio._rate / self.audio._hop, min_confidence=self.tempo_confidence
+        )
+
+    def adapt_chunk(self, chunk_controller, step_time):
+        chunk = chunk_controller.observe(
+            self.audio.callback_time + step_time,
+            self.audio._hop / self.audio._rate,
+            self.audio.input_overflows,
+        )
+        if chunk != self.audio._chunk:
+            self.audio.set_chunk(chunk)
+            if self.tempo is not None:
+                self.tempo = self.create_tempo_tracker()
+
+    def reset_categories(self, now):
+        self.band_counts = np.zeros(self.audio.filterbank.count, dtype=np.int64)
+        self.categories_time = now
+
+    def step(self, now, latency=None):
+        # `latency` overrides the measured output latency, for replays.
+        audio = self.audio
+        filterbank = audio.filterbank
+        if audio.separator is None:
+            band_diff, spectrum = audio.band_diff, audio.diff_energy_spectrum
+        else:
+            # Harmonic content picks the hue and percussive content the
+            # brightness, so sustained pads do not pulse like drum hits.
+            band_diff, spectrum = audio.band_harmonic, audio.harmonic_spectrum
+        band_counts = self.band_counts
+        loudest_band = np.argmax(band_diff)
+        if band_diff[loudest_band] > 0:
+            band_counts[loudest_band] += 1
+        band = np.argmax(band_counts)
+        dfmax, demax = filterbank.peak(spectrum, band)
+        if audio.separator is not None:
+            demax = audio.band_percussive.max()
+        self.dominant_freq = dfmax
+        self.freq_range = filterbank.ranges[band]
+        self.energy_sum += demax
+        self.energy_samples += 1
+        self.energy_range[1] = self.energy_sum / self.energy_samples
+        power = self.generate_power(demax)
+        if power == 0:
+            self.energy_sum = self.default_energy
+            self.energy_samples = 1
+        if self.tempo is not None:
+            if latency is None:
+                latency = self.output_latency()
+            self.step_latency = latency
+            # Steps before the first block carry no audio and are never
+            # recorded, so they are kept out of the onset envelope.
+            if audio.frame_index:
+                self.tempo.add(audio.frame_index, audio.band_energy, now)
+            # Pulses land on the loop step nearest to their fire time.
+            level = self.tempo.pulse(now, latency, audio._hop / audio._rate / 2)
+            if level is not None:
+                power = level * 100
+        if now - self.categories_time > 5:
+            band_counts[:] = 0
+            band_counts[band] = 1
+            self.categories_time = now
+        frange, color = self.search_range(dfmax, self.generate_color_range())
+        return color.power(power), power
+
+    def get_state(self):
+        return {
+            "energy_sum": self.energy_sum,
+            "energy_samples": self.energy_samples,
+            "energy_max": self.energy_range[1],
+            "freq_range": self.freq_range,
+            "counts": self.band_counts.tolist(),
+            "categories_time": self.categories_time,
+        }
+
+    def set_state(self, state):
+        self.energy_sum = state["energy_sum"]
+        self.energy_samples = state["energy_samples"]
+        self.energy_range[1] = state["energy_max"]
+        self.freq_range = tuple(state["freq_range"])
+        self.band_counts[:] = state["counts"]
+        self.categories_time = state["categories_time"]
+
+    def open_recorder(self):
+        if not self.record_path:
+            return None
+        samples, layout = self.audio.record_layout()
+        recorder = FrameRecorder(
+            time.strftime(self.record_path),
+            chunk=samples,
+            channel=1,
+            categories=len(self.band_counts),
+            config=dict(self.config, **layout),
+        )
+        self.audio.recorder = recorder
+        return recorder
+
     def close(self):
         ReactiveProcessing.logger.info("Main logic for reactive leds closed.")
         self.running = False
+        if self._init_futures is not None:
+            for future in self._init_futures:
+                future.exception()
+        self.audio.close_stream()
+        self.serial.close_serial()
+        self.clock.close()
+        if self.feature_server is not None:
+            self.feature_server.close()
+            self.feature_server = None
         del self.audio
         del self.serial
 
     def stop(self):
         if self.running:
             ReactiveProcessing.logger.info("Main logic for reactive leds stopped.")
+            if self.scheduler is not None:
+                self.scheduler.stop()
+            self.clock.close()
             self.serial.communicate((0, 0, 0))
             self.running = False
 
@@ -129,12 +588,7 @@ class ReactiveProcessing:
 
     def generate_color_range(self, **kwargs: dict):
         colors = self.generate_colors(kwargs=kwargs)
-        ranges = list(
-            range(
-                *self.freq_range,
-                (self.freq_range[1] - self.freq_range[0]) // len(colors)
-            )
-        )
+        ranges = np.linspace(*self.freq_range, len(colors), endpoint=False)
         return [(ranges[i], colors[i]) for i in range(len(colors))]
 
     @staticmethod
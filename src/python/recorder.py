@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import threading
+import time
+import logging
+
+import numpy as np
+
+MAGIC = b"MRLREC02"
+# Version 1 recordings have no latency field.
+MAGICS = {b"MRLREC01": 1, MAGIC: 2}
+HEADER_SIZE = 4096
+
+
+def record_dtype(samples: int, categories: int, version: int = 2):
+    fields = [
+        ("frame", "<u8"),
+        ("time", "<f8"),
+        # Loop steps taken on the frame; the loop can wake twice per block.
+        ("stepped", "u1"),
+        ("rgb", "u1", (3,)),
+        ("power", "<f4"),
+        ("step_time", "<f8"),
+        ("energy_sum", "<f8"),
+        ("energy_samples", "<i8"),
+        ("energy_max", "<f8"),
+        ("freq_range", "<f8", (2,)),
+        ("counts", "<i8", (categories,)),
+        ("categories_time", "<f8"),
+        ("samples", "<f4", (samples,)),
+    ]
+    if version >= 2:
+        # Output latency the tempo pulse was placed with; it depends on
+        # measured write times, so replay needs the recorded value.
+        fields.insert(-1, ("latency", "<f8"))
+    return np.dtype(fields)
+
+
+def read_recording(path):
+    with open(path, "rb") as f:
+        raw = f.read(HEADER_SIZE)
+    version = MAGICS.get(raw[: len(MAGIC)])
+    if version is None:
+        raise ValueError(f"{path} is not a frame recording.")
+    header = json.loads(raw[len(MAGIC) :].decode("utf-8"))
+    dtype = record_dtype(header["samples"], header["categories"], version)
+    count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if count == 0:
+        return header, np.zeros(0, dtype=dtype)
+    records = np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=count)
+    return header, records
+
+
+class FrameRecorder:
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+        self, path, chunk, channel, categories, config: dict, capacity: int = 256
+    ):
+        self.path = path
+        self.dtype = record_dtype(chunk * channel, categories)
+        self.dropped = 0
+        self.written = 0
+        self._capacity = capacity
+        self._ring = np.zeros(capacity, dtype=self.dtype)
+        self._scratch = np.zeros(capacity, dtype=self.dtype)
+        self._head = 0
+        self._tail = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = True
+
+        header = {
+            "samples": chunk * channel,
+            "categories": categories,
+            "config": config,
+        }
+        raw = MAGIC + json.dumps(header).encode("utf-8")
+        if len(raw) > HEADER_SIZE:
+            raise ValueError("Recording header does not fit in the header block.")
+        self._file = open(path, "wb")
+        self._file.write(raw.ljust(HEADER_SIZE, b" "))
+
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        FrameRecorder.logger.info(f"Recording frames to {path}.")
+
+    def add_frame(self, frame_index, samples, timestamp):
+        with self._lock:
+            if self._head - self._tail >= self._capacity:
+                self.dropped += 1
+                return
+            record = self._ring[self._head % self._capacity]
+            record["frame"] = frame_index
+            record["time"] = timestamp
+            record["stepped"] = 0
+            record["samples"] = samples
+            self._head += 1
+        self._wake.set()
+
+    def add_step(self, frame_index, timestamp, state: dict, rgb, power, latency):
+        with self._lock:
+            # The step almost always belongs to the newest frame, but the
+            # callback may have delivered another one while it was computed.
+            for position in range(self._head - 1, self._tail - 1, -1):
+                record = self._ring[position % self._capacity]
+                if record["frame"] == frame_index:
+                    break
+            else:
+                return
+            # The state from before the first step and the output of the
+            # last one, so replay can take the same steps in between.
+            if record["stepped"] == 0:
+                record["energy_sum"] = state["energy_sum"]
+                record["energy_samples"] = state["energy_samples"]
+                record["energy_max"] = state["energy_max"]
+                record["freq_range"] = state["freq_range"]
+                record["counts"] = state["counts"]
+                record["categories_time"] = state["categories_time"]
+            record["stepped"] = min(int(record["stepped"]) + 1, 255)
+            record["rgb"] = rgb
+            record["power"] = power
+            record["step_time"] = timestamp
+            record["latency"] = latency
+
+    def _write_loop(self):
+        while self._running:
+            self._wake.wait(0.5)
+            self._wake.clear()
+            self._flush(final=False)
+        self._flush(final=True)
+
+    def _flush(self, final):
+        with self._lock:
+            start = self._tail
+            # Keep the two newest frames in the ring so a late add_step can
+            # still attach its color to them.
+            end = self._head if final else self._head - 2
+            count = end - start
+            if count <= 0:
+                return
+            first = start % self._capacity
+            split = min(count, self._capacity - first)
+            self._scratch[:split] = self._ring[first : first + split]
+            self._scratch[split:count] = self._ring[: count - split]
+            self._tail = end
+        self._scratch[:count].tofile(self._file)
+        self.written += count
+
+    def close(self):
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+        self._file.close()
+        FrameRecorder.logger.info(
+            f"Recording closed: {self.written} frames written, "
+            f"{self.dropped} dropped."
+        )
+
+
+def state_from_record(record):
+    return {
+        "energy_sum": float(record["energy_sum"]),
+        "energy_samples": int(record["energy_samples"]),
+        "energy_max": float(record["energy_max"]),
+        "freq_range": tuple(record["freq_range"]),
+        "counts": [int(count) for count in record["counts"]],
+        "categories_time": float(record["categories_time"]),
+    }
+
+
+def states_match(state, expected):
+    return (
+        np.isclose(state["energy_sum"], expected["energy_sum"])
+        and state["energy_samples"] == expected["energy_samples"]
+        and np.isclose(state["energy_max"], expected["energy_max"])
+        and np.allclose(state["freq_range"], expected["freq_range"])
+        and list(state["counts"]) == expected["counts"]
+    )
+
+
+def replay(path):
+    from reactiveprocessing import ReactiveProcessing
+
+    header, records = read_recording(path)
+    config = header["config"]
+    # In separate mode every input is analysed on its own, so the recorded
+    # blocks go through a MultiSourceStream that never opens its devices.
+    separate = config.get("source_mode") == "separate"
+    sources = (
+        {"device_indices": list(range(config["inputs"])), "source_mode": "separate"}
+        if separate
+        else {}
+    )
+    processing = ReactiveProcessing(
+        arduino_port=None,
+        arduino_on=False,
+        device_index=None,
+        chunk=config["chunk"],
+        channel=config["channel"],
+        rate=config["rate"],
+        energy_range=list(config["energy_range"]),
+        reactive=config["reactive"],
+        reactive_count=config["reactive_count"],
+        colors=[tuple(color) for color in config["colors"]],
+        band_count=config["band_count"],
+        band_scale=config["band_scale"],
+        band_range=config["band_range"],
+        spectral_backend=config["spectral_backend"],
+        spectral_hop=config["spectral_hop"],
+        silence_gate=config.get("silence_gate", False),
+        silence_threshold=config.get("silence_threshold", -60.0),
+        silence_hold=config.get("silence_hold", 1.0),
+        hpss=config.get("hpss", False),
+        hpss_frames=config.get("hpss_frames", 17),
+        hpss_width=config.get("hpss_width", 17),
+        tempo=config.get("tempo", False),
+        tempo_confidence=config.get("tempo_confidence", 0.3),
+        output_latency_ms=config.get("output_latency_ms", 10.0),
+        **sources,
+    )
+    audio = processing.audio
+
+    steps = color_mismatches = state_mismatches = gaps = 0
+    diverged = []
+    stepped_frame = None
+    recorded_latency = "latency" in records.dtype.names
+    previous_frame = None
+    started = time.perf_counter()
+    for record in records:
+        if previous_frame is not None and record["frame"] != previous_frame + 1:
+            gaps += 1
+        previous_frame = record["frame"]
+        if separate:
+            audio.blocks[:] = record["samples"].reshape(audio.blocks.shape)
+            audio.blocks.sum(axis=0, out=audio.mix)
+            audio.process(audio.mix)
+        else:
+            audio.process(record["samples"])
+        if not record["stepped"]:
+            continue
+        # The recorded state is restored before every step, so a divergence
+        # is reported for the step that caused it and does not carry over.
+        state = state_from_record(record)
+        if stepped_frame is not None and not states_match(
+            processing.get_state(), state
+        ):
+            state_mismatches += 1
+            if diverged[-1:] != [stepped_frame]:
+                diverged.append(stepped_frame)
+            FrameRecorder.logger.debug(f"Frame {stepped_frame}: state diverged.")
+        processing.set_state(state)
+        stepped_frame = int(record["frame"])
+        for _ in range(int(record["stepped"])):
+            color, power = processing.step(
+                float(record["step_time"]),
+                float(record["latency"]) if recorded_latency else None,
+            )
+        if tuple(color.rgb) != tuple(record["rgb"]):
+            color_mismatches += 1
+            if diverged[-1:] != [stepped_frame]:
+                diverged.append(stepped_frame)
+            FrameRecorder.logger.debug(
+                f"Frame {stepped_frame}: color {tuple(color.rgb)}, recorded "
+                f"{tuple(record['rgb'].tolist())}."
+            )
+        steps += int(record["stepped"])
+    elapsed = time.perf_counter() - started
+
+    duration = (
+        float(records[-1]["time"] - records[0]["time"]) if len(records) > 1 else 0.0
+    )
+    result = {
+        "frames": len(records),
+        "steps": steps,
+        "color_mismatches": color_mismatches,
+        "state_mismatches": state_mismatches,
+        "gaps": gaps,
+        "diverged_frames": diverged,
+        "elapsed": elapsed,
+        "speedup": duration / elapsed if elapsed > 0 else 0.0,
+    }
+    FrameRecorder.logger.info(
+        f"Replayed {result['frames']} frames ({steps} steps) in {elapsed:.2f}s, "
+        f"{result['speedup']:.1f}x real time: {color_mismatches} color and "
+        f"{state_mismatches} state mismatches in {len(diverged)} frames, {gaps} "
+        f"gaps."
+    )
+    return result
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="Replay a frame recording through the reactive pipeline."
+    )
+    parser.add_argument("path")
+    args = parser.parse_args()
+    result = replay(args.path)
+    raise SystemExit(
+        1 if result["color_mismatches"] or result["state_mismatches"] else 0
+    )
@@ -0,0 +1,237 @@
+import argparse
+import time
+import logging
+
+import numpy as np
+
+from audiostream import AudioStream
+from clock import RealClock, VirtualClock
+from lightshow import TIMELINE_DTYPE, read_audio
+from multisource import CaptureInput, MultiSourceStream
+from reactiveprocessing import ReactiveProcessing, read_config
+
+
+class SimulatedStream:
+    # Stands in for a PyAudio input stream: delivers hop-sized blocks of the
+    # source samples to the stream callback at their due time on the clock.
+    def __init__(self, source, hop: int):
+        self.source = source
+        self.hop = hop
+        self.period = hop / source._rate
+        self._active = False
+        self._pending = None
+
+    def is_active(self):
+        return self._active
+
+    def is_stopped(self):
+        return not self._active
+
+    def get_input_latency(self):
+        return 0.0
+
+    def start_stream(self):
+        if not self._active:
+            self._active = True
+            self._origin = self.source.clock.time()
+            self._blocks = 0
+            self._schedule()
+
+    def stop_stream(self):
+        self._active = False
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+    def close(self):
+        self.stop_stream()
+
+    def _schedule(self):
+        # Due times are absolute, so delivery does not drift with callback time.
+        self._blocks += 1
+        self._pending = self.source.clock.call_at(
+            self._origin + self._blocks * self.period, self._deliver
+        )
+
+    def _deliver(self):
+        if not self._active:
+            return
+        block = self.source.read(self.hop)
+        if block is None:
+            self._active = False
+            self.source.finished()
+            return
+        self._schedule()
+        self.source._procces_stream(block.tobytes(), self.hop, None, 0)
+
+
+class SimulatedAudioStream(AudioStream):
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, samples, chunk, channel, rate, device_index=None, **kwargs):
+        super().__init__(chunk, channel, rate, device_index, **kwargs)
+        self.samples = np.asarray(samples, dtype=np.float32)
+        self.position = 0
+        self.on_finished = None
+
+    def open_stream(self):
+        if self.stream is None:
+            self.stream = SimulatedStream(self, self._hop)
+
+    def read(self, count: int):
+        if self.position + count > len(self.samples):
+            return None
+        block = self.samples[self.position : self.position + count]
+        self.position += count
+        return block
+
+    def finished(self):
+        SimulatedAudioStream.logger.info(
+            f"Simulated source finished after {self.position} samples."
+        )
+        if self.on_finished is not None:
+            self.on_finished()
+
+
+class SimulatedInput(CaptureInput):
+    logger = logging.getLogger(__name__)
+
+    # A capture device whose clock runs `skew` fast (negative for slow): it
+    # samples the same sound at rate * (1 + skew) while claiming `rate`.
+    def __init__(self, samples, rate, skew=0.0, channel=1, clock=None):
+        super().__init__(None, rate, channel, clock)
+        self._rate = rate * (1 + skew)
+        positions = np.arange(int(len(samples) * (1 + skew))) / (1 + skew)
+        self.samples = np.interp(positions, np.arange(len(samples)), samples).astype(
+            np.float32
+        )
+        self.skew = skew
+        self.offset = 0
+        self.on_finished = None
+
+    def open_stream(self):
+        if self.stream is None:
+            self.stream = SimulatedStream(self, self._hop)
+
+    def read(self, count: int):
+        if self.offset + count > len(self.samples):
+            return None
+        block = self.samples[self.offset : self.offset + count]
+        self.offset += count
+        return block
+
+    def finished(self):
+        SimulatedInput.logger.info(
+            f"Simulated input skewed {self.skew * 1e6:+.0f} ppm finished after "
+            f"{self.offset} samples."
+        )
+        if self.on_finished is not None:
+            self.on_finished()
+
+
+class RecordingOutput:
+    # Stands in for ArduinoSerial and keeps every frame that would have been
+    # written, stamped with the clock time it was sent at.
+    def __init__(self, clock, port=None, arduino=True, pixels=1, encoding="auto"):
+        self.clock = clock
+        self.pixels = pixels
+        self.is_open = False
+        self.times = []
+        self.frames = []
+
+    def start_serial(self):
+        self.is_open = True
+
+    def close_serial(self):
+        if self.is_open:
+            self.communicate((0, 0, 0))
+            self.is_open = False
+
+    def communicate(self, rgb: tuple):
+        if self.pixels > 1:
+            self.communicate_frame(bytes(rgb) * self.pixels)
+        elif self.is_open:
+            self.times.append(self.clock.time())
+            self.frames.append(bytes(rgb))
+
+    def communicate_frame(self, frame):
+        if self.is_open:
+            self.times.append(self.clock.time())
+            self.frames.append(bytes(frame))
+
+    def timeline(self):
+        # Single-pixel runs in the format lightshow.py plays back.
+        timeline = np.zeros(len(self.frames), dtype=TIMELINE_DTYPE)
+        timeline["time"] = self.times
+        timeline["rgb"] = np.frombuffer(b"".join(self.frames), dtype=np.uint8).reshape(
+            -1, 3
+        )
+        return timeline
+
+
+def simulate(config: dict, samples, rate: int, clock=None, skews=(), **overrides):
+    # With skews, the samples are captured by one simulated device per skew
+    # and mixed by a MultiSourceStream.
+    clock = VirtualClock() if clock is None else clock
+    if skews:
+        audio_source = lambda **kwargs: MultiSourceStream(
+            mode=config.get("source_mode", "mix").lower(),
+            inputs=[SimulatedInput(samples, rate, skew, clock=clock) for skew in skews],
+            **kwargs,
+        )
+    else:
+        audio_source = lambda **kwargs: SimulatedAudioStream(samples, **kwargs)
+    processing = ReactiveProcessing.from_config(
+        config,
+        channel=1,
+        rate=rate,
+        device_index=None,
+        clock=clock,
+        audio_source=audio_source,
+        output=lambda **kwargs: RecordingOutput(clock, **kwargs),
+        **overrides,
+    )
+    for source in getattr(processing.audio, "inputs", [processing.audio]):
+        source.on_finished = processing.stop
+    output = processing.serial
+    try:
+        processing.start()
+    finally:
+        processing.close()
+    return output
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
+    )
+    parser = argparse.ArgumentParser(
+        description="Run the reactive loop on a WAV file with simulated devices."
+    )
+    parser.add_argument("audio")
+    parser.add_argument("--timeline", help="save the sent colors as a timeline")
+    parser.add_argument(
+        "--realtime", action="store_true", help="pace the run with the wall clock"
+    )
+    parser.add_argument(
+        "--skew",
+        type=float,
+        nargs="+",
+        default=[],
+        help="capture with one simulated device per clock skew, in ppm",
+    )
+    args = parser.parse_args()
+
+    rate, samples = read_audio(args.audio)
+    clock = RealClock() if args.realtime else VirtualClock()
+    started = time.perf_counter()
+    skews = [skew * 1e-6 for skew in args.skew]
+    output = simulate(read_config(), samples, rate, clock, skews, pixel_count=1)
+    elapsed = time.perf_counter() - started
+    duration = len(samples) / rate
+    SimulatedAudioStream.logger.info(
+        f"Sent {len(output.frames)} frames for {duration:.1f}s of audio in "
+        f"{elapsed:.2f}s, {duration / elapsed:.1f}x real time."
+    )
+    if args.timeline:
+        np.save(args.timeline, output.timeline())
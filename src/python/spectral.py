@@ -0,0 +1,134 @@
+import numpy as np
+import scipy.fft
+import logging
+
+
+def hann(chunk: int):
+    # Periodic Hann window. In the frequency domain it is the three-tap
+    # kernel SlidingDftBackend applies, so all backends agree.
+    return 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(chunk) / chunk)
+
+
+class SpectralBackend:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, chunk: int, hop: int, lower_bin: int, upper_bin: int):
+        self.chunk = chunk
+        self.hop = hop
+        self.lower_bin = lower_bin
+        self.upper_bin = upper_bin
+        self.samples = np.zeros(chunk)
+
+    def push(self, block):
+        # Keep the latest `chunk` samples; with hop == chunk this is a copy.
+        hop = len(block)
+        self.samples[:-hop] = self.samples[hop:]
+        self.samples[-hop:] = block
+
+    def skip(self, block):
+        # Called instead of spectrum for blocks that are not analysed.
+        self.push(block)
+
+    def spectrum(self, block, out):
+        raise NotImplementedError
+
+
+class FftBackend(SpectralBackend):
+    def __init__(self, chunk, hop, lower_bin, upper_bin):
+        super().__init__(chunk, hop, lower_bin, upper_bin)
+        self.window = hann(chunk)
+        self._windowed = np.zeros(chunk)
+
+    def spectrum(self, block, out):
+        self.push(block)
+        np.multiply(self.samples, self.window, out=self._windowed)
+        fft = scipy.fft.rfft(self._windowed)
+        np.multiply(fft.real, fft.real, out=out)
+        out += fft.imag**2
+
+
+class DftBackend(SpectralBackend):
+    # Evaluates only the bins used by the filterbank. This is what running a
+    # Goertzel filter per bin computes, done as one matrix product instead of
+    # a per-sample Python recurrence.
+    def __init__(self, chunk, hop, lower_bin, upper_bin):
+        super().__init__(chunk, hop, lower_bin, upper_bin)
+        bins = np.arange(lower_bin, upper_bin)[:, None]
+        n = np.arange(chunk)[None, :]
+        self.basis = hann(chunk) * np.exp(-2j * np.pi * bins * n / chunk)
+
+    def spectrum(self, block, out):
+        self.push(block)
+        dft = self.basis @ self.samples
+        out[self.lower_bin : self.upper_bin] = dft.real**2 + dft.imag**2
+
+
+class SlidingDftBackend(SpectralBackend):
+    # Updates the used bins incrementally from the samples entering and
+    # leaving the window, so the cost scales with hop * bins rather than
+    # with the window length. The Hann window is applied in the frequency
+    # domain as a three-tap kernel over neighbouring bins.
+    resync_interval = 256
+
+    def __init__(self, chunk, hop, lower_bin, upper_bin):
+        super().__init__(chunk, hop, lower_bin, upper_bin)
+        self._first = max(lower_bin - 1, 0)
+        self._last = min(upper_bin + 1, chunk // 2 + 1)
+        bins = np.arange(self._first, self._last)
+        self._bins = bins
+        self._rotation = np.exp(2j * np.pi * bins * hop / chunk)
+        m = np.arange(hop)
+        self._basis = np.exp(2j * np.pi * bins[:, None] * (hop - m[None, :]) / chunk)
+        self._dft = np.zeros(len(bins), dtype=complex)
+        self._delta = np.zeros(hop)
+        self._updates = 0
+        self._stale = False
+
+    def skip(self, block):
+        self.push(block)
+        self._stale = True
+
+    def spectrum(self, block, out):
+        if len(block) != self.hop:
+            raise ValueError(f"Sliding DFT expects blocks of {self.hop} samples.")
+        np.subtract(block, self.samples[: self.hop], out=self._delta)
+        self.push(block)
+        self._updates += 1
+        if self._stale or self._updates % self.resync_interval == 0:
+            # Recompute from the window after skipped blocks, and regularly
+            # to stop rounding errors accumulating.
+            self._dft = scipy.fft.rfft(self.samples)[self._first : self._last]
+            self._stale = False
+        else:
+            self._dft *= self._rotation
+            self._dft += self._basis @ self._delta
+
+        dft = self._dft
+        lower = self.lower_bin - self._first
+        upper = lower + self.upper_bin - self.lower_bin
+        # Bins below 0 and above Nyquist mirror the ones inside for real input.
+        if lower > 0:
+            below = dft[lower - 1 : upper - 1]
+        else:
+            below = np.concatenate((dft[1:2].conj(), dft[: upper - 1]))
+        if upper < len(dft):
+            above = dft[lower + 1 : upper + 1]
+        else:
+            above = np.concatenate((dft[lower + 1 :], dft[-2:-1].conj()))
+        windowed = 0.5 * dft[lower:upper]
+        windowed -= 0.25 * below
+        windowed -= 0.25 * above
+        out[self.lower_bin : self.upper_bin] = windowed.real**2 + windowed.imag**2
+
+
+BACKENDS = {
+    "fft": FftBackend,
+    "dft": DftBackend,
+    "sdft": SlidingDftBackend,
+}
+
+
+def create_backend(name: str, chunk: int, hop: int, lower_bin: int, upper_bin: int):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown spectral backend: {name}")
+    return BACKENDS[name](chunk, hop, lower_bin, upper_bin)
@@ -0,0 +1,132 @@
+import numpy as np
+import scipy.fft
+import logging
+
+
+class TempoTracker:
+    logger = logging.getLogger(__name__)
+
+    def __init__(
+        self,
+        frame_rate: float,
+        history: float = 8.0,
+        bpm_range=(60, 180),
+        interval: float = 0.5,
+        min_confidence: float = 0.3,
+        decay: float = 0.1,
+    ):
+        self.frame_rate = frame_rate
+        self.min_confidence = min_confidence
+        self.decay = decay
+        self.envelope = np.zeros(max(int(history * frame_rate), 4))
+        self.interval = max(int(interval * frame_rate), 1)
+        frames = len(self.envelope)
+        self._lags = np.arange(frames)
+        # Candidate periods in frames, every half BPM across the range, and
+        # the lags of their first few multiples that fit in half the history.
+        bpm = np.arange(bpm_range[0], bpm_range[1] + 0.5, 0.5)
+        self._periods = 60 * frame_rate / bpm
+        multiples = np.arange(1, 5)
+        self._multiple_lags = self._periods[:, None] * multiples[None, :]
+        self._multiple_valid = self._multiple_lags < frames // 2
+        # Prefer tempi near 120 BPM when several periods fit about equally well.
+        self._prior = np.exp(-0.5 * np.log2(bpm / 120) ** 2)
+        self._previous = None
+        self.frame_index = None
+        self.frames = 0
+        self.bpm = 0.0
+        self.period = 0.0
+        self.confidence = 0.0
+        self.locked = False
+        self._beat = None
+
+    def add(self, frame_index: int, band_energy, now: float):
+        if frame_index == self.frame_index:
+            return
+        energy = np.log1p(band_energy)
+        if self._previous is None or len(self._previous) != len(energy):
+            self._previous = energy
+        # Onset strength: rise of the log band energies, summed over bands.
+        onset = np.maximum(energy - self._previous, 0).sum()
+        self._previous = energy
+        # Frames the loop did not step through repeat the current onset.
+        missed = 1 if self.frame_index is None else frame_index - self.frame_index
+        missed = min(max(missed, 1), len(self.envelope))
+        self.envelope[:-missed] = self.envelope[missed:]
+        self.envelope[-missed:] = onset
+        self.frame_index = frame_index
+        self.time = now
+        self.frames += missed
+        if self.frames >= self.interval:
+            self.frames = 0
+            self.estimate()
+
+    def estimate(self):
+        envelope = self.envelope - self.envelope.mean()
+        frames = len(envelope)
+        spectrum = scipy.fft.rfft(envelope, 2 * frames)
+        autocorrelation = scipy.fft.irfft(spectrum.real**2 + spectrum.imag**2)[:frames]
+        if autocorrelation[0] <= 0:
+            self._update_lock(0.0)
+            return
+        # Unbiased and normalized, so 1 means a perfectly periodic envelope.
+        autocorrelation /= (frames - self._lags) * (autocorrelation[0] / frames)
+        # A period fits when the envelope also correlates at its multiples;
+        # interpolating between lags allows periods between whole frames.
+        fits = np.interp(self._multiple_lags, self._lags, autocorrelation)
+        fits = np.where(self._multiple_valid, fits, 0).sum(axis=1) / np.maximum(
+            self._multiple_valid.sum(axis=1), 1
+        )
+        best = np.argmax(fits * self._prior)
+        period = float(self._periods[best])
+        self.period = period
+        self.bpm = 60 * self.frame_rate / period
+        self._beat = self.frame_index - self._phase(period)
+        self._update_lock(float(fits[best]))
+
+    def _phase(self, period):
+        # Frames since the last beat: the offset whose comb of beats, going
+        # back through the history, lines up with the most onset strength.
+        # Offsets are tried in quarter frames, as the period is fractional.
+        frames = len(self.envelope)
+        offsets = np.arange(0, period, 0.25)
+        beats = np.arange(int((frames - 1) // period) or 1) * period
+        positions = frames - 1 - offsets[:, None] - beats[None, :]
+        scores = np.interp(positions, self._lags, self.envelope, left=0).sum(axis=1)
+        return float(offsets[np.argmax(scores)])
+
+    def _update_lock(self, confidence):
+        self.confidence = confidence
+        # Some hysteresis, so a confidence near the threshold does not make
+        # the output flap between modes.
+        threshold = self.min_confidence * (0.8 if self.locked else 1.0)
+        locked = confidence >= threshold
+        if locked and not self.locked:
+            TempoTracker.logger.info(
+                f"Tempo locked at {self.bpm:.1f} BPM "
+                f"(confidence {confidence:.2f}), pulsing on predicted beats."
+            )
+        elif self.locked and not locked:
+            TempoTracker.logger.info(
+                f"Tempo confidence dropped to {confidence:.2f}, "
+                f"falling back to reactive mode."
+            )
+        self.locked = locked
+
+    def next_beat(self, now: float):
+        # Clock time of the next predicted beat, as the onset would be seen
+        # by the analysis.
+        beat = self.time + (self._beat - self.frame_index) / self.frame_rate
+        seconds = self.period / self.frame_rate
+        return beat + np.ceil((now - beat) / seconds) * seconds
+
+    def pulse(self, now: float, latency: float, tolerance: float = 0.0):
+        # Brightness in [0, 1] for a pulse fired `latency` ahead of each
+        # predicted beat, or None when the tempo is not trusted.
+        if not self.locked:
+            return None
+        seconds = self.period / self.frame_rate
+        fired = self.next_beat(now + latency + tolerance) - latency
+        if fired > now + tolerance:
+            fired -= seconds
+        return float(np.exp(-max(now - fired, 0) / self.decay))